@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Offline benchmarks for dayonerunlog. The SmashRun client, the Strava client and
+# dayone2 are replaced with local stand-ins fed from synthetic fixtures (or recorded
+# ones, see --fixtures), so nothing here talks to a real service.
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from datetime import timedelta
+from dateutil.tz import tzoffset
+from smashrun.client import to_timestamp
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+import dayonerunlog
+
+
+FIXTURE_TZ = tzoffset(None, -7 * 60 * 60)
+FIXTURE_START = datetime(2015, 1, 1, 6, 0, 0, tzinfo=FIXTURE_TZ)
+FIXTURE_TEMPLATES = 16
+FIXTURE_PHOTOS = 5
+FAKE_DAYONE2 = '#!/bin/sh\ncat > /dev/null\n'
+FAKE_PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 4096
+
+
+def synthetic_pairs(count, seed=0):
+    rng = random.Random(seed)
+    tz = tzoffset(None, -7 * 60 * 60)
+    start = datetime(2010, 1, 1, 6, 0, 0, tzinfo=tz)
+
+    sr_runs = []
+    st_runs = []
+    for idx in range(count):
+        # Roughly one run every 8 hours, with a few runs close together to exercise ambiguity
+        localtime = start + timedelta(seconds=idx * 8 * 60 * 60 + rng.randint(0, 60))
+        distance_in_km = rng.uniform(3.0, 42.2)
+        sr_runs.append({'__id': {'smashrun': idx},
+                        '__localtime': localtime,
+                        'distance': distance_in_km})
+
+        utc = localtime + timedelta(seconds=rng.randint(-30, 30)) - localtime.utcoffset()
+        st_runs.append({'id': 1000000 + idx,
+                        'start_date': utc.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                        'distance': distance_in_km * 1000.0 + rng.uniform(-50.0, 50.0)})
+
+    rng.shuffle(st_runs)
+    return sr_runs, st_runs
+
+
+def synthetic_recording(distance_in_km, seed):
+    # A 1 Hz recording at roughly 6:00/km
+    rng = random.Random(seed)
+    samples = int(distance_in_km * 360)
+    step = distance_in_km / samples
+    clock, distance, latitude, longitude, heart_rate = [], [], [], [], []
+    lat, lng = 37.77, -122.42
+    for idx in range(samples):
+        clock.append(float(idx))
+        distance.append(idx * step * rng.uniform(0.9, 1.1))
+        lat += rng.uniform(-0.0001, 0.0001)
+        lng += rng.uniform(-0.0001, 0.0001)
+        latitude.append(lat)
+        longitude.append(lng)
+        heart_rate.append(float(rng.randint(120, 170)))
+    # Keep the distance channel cumulative
+    for idx in range(1, samples):
+        distance[idx] = max(distance[idx], distance[idx - 1])
+    return {'recordingKeys': ['clock', 'distance', 'latitude', 'longitude', 'heartRate'],
+            'recordingValues': [clock, distance, latitude, longitude, heart_rate]}
+
+
+class SyntheticFixtures(object):
+    def __init__(self, count, image_url, seed=0):
+        rng = random.Random(seed)
+        self.userinfo = {'userName': 'benchmark'}
+        # Recordings are the expensive part to generate, so activities share a few templates
+        self.templates = [synthetic_recording(3.0 + idx * 2.5, seed + idx) for idx in range(FIXTURE_TEMPLATES)]
+
+        self.sr_activities = []
+        self.sr_details = {}
+        self.st_activities = []
+        self.st_details = {}
+        self.badges = []
+        for idx in range(count):
+            template = self.templates[idx % FIXTURE_TEMPLATES]
+            distance_in_km = template['recordingValues'][1][-1]
+            localtime = FIXTURE_START + timedelta(seconds=idx * 8 * 60 * 60 + rng.randint(0, 60))
+            activity_id = 5000000 + idx
+            self.sr_activities.append({'activityId': activity_id,
+                                       'activityType': 'running',
+                                       'startDateTimeLocal': localtime.strftime('%Y-%m-%dT%H:%M:%S') + '-07:00',
+                                       'distance': distance_in_km,
+                                       'notes': 'Synthetic run %d' % (idx)})
+            self.sr_details[activity_id] = template
+
+            utc = localtime + timedelta(seconds=rng.randint(-30, 30)) - localtime.utcoffset()
+            st_summary = {'id': 9000000 + idx,
+                          'type': 'Run',
+                          'start_date': utc.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          'distance': distance_in_km * 1000.0 + rng.uniform(-50.0, 50.0)}
+            self.st_activities.append(st_summary)
+            st_detail = dict(st_summary)
+            st_detail['map'] = {'polyline': '_p~iF~ps|U_ulLnnqC_mqNvxq`@'}
+            self.st_details[st_summary['id']] = st_detail
+
+            if idx % 20 == 0:
+                earned = (localtime + timedelta(hours=1)).astimezone(tzoffset(None, 0))
+                self.badges.append({'name': 'Badge %d' % (idx),
+                                    'requirement': 'Run %d times' % (idx),
+                                    'image': '%s/badges/medium/%d.png' % (image_url, idx),
+                                    'dateEarnedUTC': earned.strftime('%Y-%m-%dT%H:%M:%S') + '.123'})
+
+        # SmashRun lists newest first
+        self.sr_activities.reverse()
+
+    def window(self):
+        first = FIXTURE_START - timedelta(days=1)
+        last = FIXTURE_START + timedelta(hours=8 * len(self.sr_details)) + timedelta(days=1)
+        return first, last
+
+
+class RecordedFixtures(object):
+    # A directory of JSON files captured from the real services:
+    #   smashrun_userinfo.json, smashrun_badges.json, smashrun_activities.json (newest first),
+    #   smashrun_details.json ({activityId: get_activity()}), strava_activities.json (summaries)
+    #   and strava_details.json ({id: /activities/{id}})
+    def __init__(self, path):
+        def load(name, default):
+            fname = os.path.join(path, name)
+            if not os.path.isfile(fname):
+                return default
+            with open(fname, 'r') as fh:
+                return json.load(fh)
+
+        self.userinfo = load('smashrun_userinfo.json', {'userName': 'benchmark'})
+        self.badges = load('smashrun_badges.json', [])
+        self.sr_activities = load('smashrun_activities.json', [])
+        self.sr_details = dict((int(k), v) for k, v in load('smashrun_details.json', {}).items())
+        self.st_activities = load('strava_activities.json', [])
+        self.st_details = dict((int(k), v) for k, v in load('strava_details.json', {}).items())
+
+    def window(self):
+        times = [datetime.strptime(a['startDateTimeLocal'][:19], '%Y-%m-%dT%H:%M:%S') for a in self.sr_activities]
+        return min(times) - timedelta(days=1), max(times) + timedelta(days=1)
+
+
+class FakeSmashrun(object):
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.session = FakeSmashrunSession(fixtures)
+
+    def get_userinfo(self):
+        return self.fixtures.userinfo
+
+    def get_badges(self):
+        return list(self.fixtures.badges)
+
+    def _build_url(self, *parts):
+        return '/'.join(str(part) for part in parts)
+
+    def get_activity(self, id_num):
+        return self.fixtures.sr_details[id_num]
+
+
+class FakeResponse(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+class FakeSmashrunSession(object):
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+
+    def get(self, url, params=None):
+        if url != 'my/activities/search':
+            raise ValueError("Unexpected SmashRun request %s" % (url))
+        # The search endpoint compares local start times, newest first
+        from_date, to_date = params.get('fromDate'), params.get('toDate')
+        activities = []
+        for activity in self.fixtures.sr_activities:
+            local = to_timestamp(datetime.strptime(activity['startDateTimeLocal'][:19], '%Y-%m-%dT%H:%M:%S'))
+            if (from_date is None or local >= from_date) and (to_date is None or local <= to_date):
+                activities.append(activity)
+        offset = params['page'] * params['count']
+        return FakeResponse(activities[offset:offset + params['count']])
+
+
+class FakeStravaProtocol(object):
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+
+    def get(self, url, check_for_errors=True, **kwargs):
+        if url == '/athlete/activities':
+            page = kwargs.get('page', 1)
+            per_page = kwargs.get('per_page', 30)
+            return self.fixtures.st_activities[(page - 1) * per_page:page * per_page]
+        elif url == '/activities/{id}':
+            return self.fixtures.st_details[kwargs['id']]
+        raise ValueError("Unexpected Strava request %s" % (url))
+
+
+class FakeStrava(object):
+    def __init__(self, fixtures):
+        self.protocol = FakeStravaProtocol(fixtures)
+        self.access_token = 'benchmark'
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # Serves a PNG for any path, plus Strava photo listings (a few photos for every tenth activity)
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    # Send each response in one write, or Nagle and delayed ACKs add ~40ms to every keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = self.path.split('?')[0]
+        if path.startswith('/activities/') and path.endswith('/photos'):
+            activity_id = int(path.split('/')[2])
+            etag = '"%d"' % (activity_id)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            photos = []
+            if activity_id % 10 == 0:
+                for idx in range(FIXTURE_PHOTOS):
+                    url = 'http://%s/photos/%d-%d.png' % (self.headers.get('Host'), activity_id, idx)
+                    photos.append({'unique_id': 'photo-%d-%d' % (activity_id, idx), 'urls': {'1000': url}})
+            body = json.dumps(photos).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            etag = None
+            body = FAKE_PNG
+            content_type = 'image/png'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class OfflineEnvironment(object):
+    # Swaps the service clients and dayone2 for local stand-ins for the duration of a with block
+    def __init__(self, fixtures, api_url):
+        self.fixtures = fixtures
+        self.api_url = api_url
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='dayonerun_bench_')
+        dayone2 = os.path.join(self.tmpdir, 'dayone2')
+        with open(dayone2, 'w') as fh:
+            fh.write(FAKE_DAYONE2)
+        os.chmod(dayone2, os.stat(dayone2).st_mode | stat.S_IXUSR)
+
+        self.saved = (os.environ['PATH'], os.getcwd(), dayonerunlog.smashrun_client, dayonerunlog.strava_client,
+                      dayonerunlog.STRAVA_API_URL)
+        os.environ['PATH'] = self.tmpdir + os.pathsep + os.environ['PATH']
+        os.chdir(self.tmpdir)
+        dayonerunlog.smashrun_client = lambda **kwargs: FakeSmashrun(self.fixtures)
+        dayonerunlog.strava_client = lambda **kwargs: FakeStrava(self.fixtures)
+        dayonerunlog.STRAVA_API_URL = self.api_url
+
+        self.credentials = os.path.join(self.tmpdir, 'credentials.yaml')
+        with open(self.credentials, 'w') as fh:
+            fh.write('smashrun: {}\nstrava: {}\n')
+        return self
+
+    def __exit__(self, *exc):
+        os.environ['PATH'], cwd, dayonerunlog.smashrun_client, dayonerunlog.strava_client, \
+            dayonerunlog.STRAVA_API_URL = self.saved
+        os.chdir(cwd)
+        shutil.rmtree(self.tmpdir)
+
+
+def quiet_logging():
+    # setup() installs an INFO console handler each time it's called
+    root = logging.getLogger('')
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.StreamHandler())
+    root.setLevel(logging.WARNING)
+
+
+def timed(results, name, count, fn):
+    t0 = time.time()
+    fn()
+    elapsed = time.time() - t0
+    results.append({'benchmark': name, 'count': count, 'seconds': elapsed})
+    print("%-22s %8d %10.3fs" % (name, count, elapsed))
+
+
+def bench_matching(results, count):
+    sr_runs, st_runs = synthetic_pairs(count)
+
+    def match():
+        st_index = dayonerunlog.StravaRunIndex(st_runs)
+        matched = sum(1 for sr_run in sr_runs if dayonerunlog.st_find_strava_run(sr_run, st_index) is not None)
+        assert matched == count, "Only matched %d of %d runs" % (matched, count)
+
+    timed(results, 'st_find_strava_run', count, match)
+
+
+def bench_splits(results, fixtures, count):
+    details = [fixtures.templates[idx % FIXTURE_TEMPLATES] for idx in range(count)]
+    recordings = []
+    splits = []
+    # Building pint's registry is a one-off, so keep it out of the per-activity numbers
+    dayonerunlog.units()
+    timed(results, 'RecordingStream', count,
+          lambda: recordings.extend(dayonerunlog.RecordingStream(d) for d in details))
+    timed(results, 'sr_get_split_info', count,
+          lambda: splits.extend(dayonerunlog.sr_get_split_info(r) for r in recordings))
+    timed(results, 'gen_split_markdown', count, lambda: [dayonerunlog.gen_split_markdown(s) for s in splits])
+
+
+def bench_end_to_end(results, fixtures, count, api_url, extra_args):
+    # The second pass over the same window runs against the cache and image store the first one filled
+    with OfflineEnvironment(fixtures, api_url) as env:
+        start, stop = fixtures.window()
+        argv = ['--credentials_file', env.credentials,
+                '--start', start.strftime('%Y-%m-%dT%H:%M:%S'),
+                '--stop', stop.strftime('%Y-%m-%dT%H:%M:%S'),
+                '--cache_file', os.path.join(env.tmpdir, 'cache.sqlite'),
+                '--image_store', os.path.join(env.tmpdir, 'images')]
+        for service in dayonerunlog.CFG_RATE_LIMITS:
+            argv.extend(['--rate_limit', '%s=' % (service)])
+        for name in ('main', 'main (re-run)'):
+            args = dayonerunlog.setup(argv + extra_args)
+            quiet_logging()
+            timed(results, name, count, lambda: dayonerunlog.main(args))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=str, default='10,1000,10000', help='Comma separated activity counts')
+    parser.add_argument('--pairs', type=int, help='Only match this many synthetic SmashRun/Strava pairs')
+    parser.add_argument('--fixtures', type=str, help='Directory of recorded fixtures to use for the end-to-end run')
+    parser.add_argument('--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('--main_args', type=str, default='', help='Extra dayonerunlog options for the end-to-end run')
+    parser.add_argument('--latency_ms', type=float, default=0.0, help='Delay every response from the local server')
+    args = parser.parse_args(argv)
+
+    quiet_logging()
+    ImageHandler.latency = args.latency_ms / 1000.0
+    image_server = ImageServer(('127.0.0.1', 0), ImageHandler)
+    server = threading.Thread(target=image_server.serve_forever)
+    server.daemon = True
+    server.start()
+    image_url = 'http://127.0.0.1:%d' % (image_server.server_port)
+
+    results = []
+    print("%-22s %8s %11s" % ('Benchmark', 'Count', 'Time'))
+    if args.pairs:
+        bench_matching(results, args.pairs)
+        return 0
+
+    for count in [int(x) for x in args.scales.split(',')]:
+        fixtures = SyntheticFixtures(count, image_url)
+        bench_matching(results, count)
+        bench_splits(results, fixtures, count)
+        bench_end_to_end(results, fixtures, count, image_url, args.main_args.split())
+
+    if args.fixtures:
+        fixtures = RecordedFixtures(args.fixtures)
+        bench_end_to_end(results, fixtures, len(fixtures.sr_activities), image_url, args.main_args.split())
+
+    image_server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
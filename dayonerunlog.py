@@ -28,29 +28,54 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
 # POSSIBILITY OF SUCH DAMAGE. 
 
-# FIXME: Remove get_activity_photos workarounds if stravalib gets fixed
-# FIXME: Bug when there are two runs on the same day a badge is required -- I think both will get it
 
 import argparse
+import array
+import atexit
+import bisect
+import calendar
+import collections
 import dateutil
+import email.utils
+import errno
 import functools
+import hashlib
+import itertools
+import json
 import logging
+import math
+import operator
 import pprint
 import os
+import Queue
+import random
 import requests
-import stravalib
+import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
 import sys
 import tempfile
+import types
+import threading
+import time
 import urllib
+import uuid
 import yaml
+import zipfile
+import zlib
 
 from smashrun.client import Smashrun
-from stravalib.client import Client
+from smashrun.client import to_timestamp
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
 from dateutil.tz import tzoffset
-from pint import UnitRegistry
+from multiprocessing.pool import ThreadPool
+
+# stravalib and pint are imported where they're first used. Together with pint's unit registry they
+# account for most of the start-up time, and a poll that finds nothing new needs neither.
 
 
 def custom_title(run):
@@ -68,17 +93,62 @@ CFG_START_TIME_THRESHOLD_IN_SECS = 90
 CFG_DISTANCE_THRESHOLD_IN_METERS = 150
 CFG_STRAVA_PHOTO_SIZE = 1000
 CFG_ACTIVITY_TITLE_FN = custom_title  # For an example, look at the custom_title def
+CFG_CONCURRENCY = 4
+CFG_RATE_LIMITS = {'smashrun': 5.0, 'strava': 2.0, 'google': 10.0}  # Max requests per second per service
+CFG_CACHE_FILE = '~/.dayonerunlog/cache.sqlite'
+CFG_CACHE_TTL_IN_DAYS = 180
+CFG_CACHE_MAX_SIZE_IN_MB = 512
+CFG_IMAGE_STORE_DIR = '~/.dayonerunlog/images'
+CFG_HTTP_POOL_SIZE = 10
+CFG_HTTP_RETRIES = 4
+CFG_HTTP_TIMEOUT_IN_SECS = 30
+CFG_HTTP_MAX_RETRY_DELAY_IN_SECS = 120  # A longer Retry-After from a server is cut down to this
+CFG_MAX_DOWNLOAD_SIZE_IN_MB = 50  # Downloads larger than this are dropped. None disables the check
+CFG_DAYONE_JOBS = 2
+CFG_SMASHRUN_WINDOW_IN_DAYS = 31  # SmashRun activities are requested in date slices of this size
+CFG_ROUTE_RENDERER = 'local'  # 'local' draws route maps offline, 'google' uses the Static Maps API
+CFG_ROUTE_SIZE_IN_PIXELS = 640
+CFG_ROUTE_TOLERANCE_IN_PIXELS = 1.0  # Route points closer than this to the simplified line are dropped
+CFG_SCRATCH_DIR = None  # Where photos wait for dayone2. None keeps them in the image store, '/dev/shm' in memory
+CFG_SCRATCH_QUOTA_IN_MB = 512  # Photos wait for earlier entries to free up space beyond this. None disables
+CFG_WATCH_MIN_INTERVAL_IN_SECS = 300  # --watch polls this often after finding a run...
+CFG_WATCH_MAX_INTERVAL_IN_SECS = 3600  # ...backing off to this while nothing turns up
+CFG_WATCH_LOOKBACK_IN_HOURS = 24  # Each --watch poll also looks for runs that started this long before the last one
 
 
 # Generally nothing below this line should be changed
-UNITS = UnitRegistry()
+UNITS = None
+UNITS_LOCK = threading.Lock()
 STATE_FILE_PREFIX = 'LastUpdateStop: '
+STATE_FILE_CHECKPOINT_PREFIX = 'Checkpoint: '
+STATE_FILE_PROCESSED_PREFIX = 'Processed: '
+STATE_FILE_PROCESSED_SINCE_PREFIX = 'ProcessedSince: '
 STATE_FILE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'  # this is in local time
+RATE_LIMITERS = {}
+HTTP_CLIENT = None
+SCRATCH = None
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+STRAVA_PAGE_SIZE = 200  # The maximum Strava allows
+STRAVA_API_URL = 'https://www.strava.com/api/v3'
+SMASHRUN_PAGE_SIZE = 100
+SMASHRUN_MAX_WINDOW_IN_DAYS = 366
+SMASHRUN_WINDOW_SLACK = timedelta(days=2)  # Activity times are local to wherever the run was
+ROUTE_LINE_WIDTH = 6
+ROUTE_PALETTE = [(255, 255, 255), (0, 0, 255), (0, 160, 0), (220, 0, 0)]  # background, route, start, finish
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+STREAM_END = object()  # Closes a pool_stream queue
+SCRATCH_WAIT_IN_SECS = 300  # How long a photo waits for scratch space before going over the quota
+TOKEN_EXPIRY_MARGIN_IN_SECS = 300
+# Options that configure the process rather than an athlete, so a manifest can't set them per athlete
+MANIFEST_SHARED_OPTIONS = ('manifest', 'watch', 'concurrency', 'rate_limit', 'cache_file', 'image_store', 'no_cache',
+                           'refresh', 'http_pool_size', 'scratch_dir', 'profile', 'profile_output', 'debug')
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--credentials_file', type=str, required=True, help='The name of the file holding service credentials')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'backfill'], help='backfill fetches whole months in parallel')  # noqa
+    parser.add_argument('--credentials_file', type=str,                help='The name of the file holding service credentials')
+    parser.add_argument('--manifest',         type=str,                help='YAML file listing athletes, each with their own credentials, journal and state file')  # noqa
     parser.add_argument('--journal',          type=str,                help='The name of the DayOne journal to use')
     parser.add_argument('--start',            type=str,                help='An initial start date of the form YYYY-MM-DD[THH:MM:SS]')
     parser.add_argument('--stop',             type=str,                help='An end date of the form YYYY-MM-DD[THH:MM:SS]')
@@ -86,15 +156,69 @@ def parse_args(argv):
     parser.add_argument('--tag', dest='tags', type=str, default=[],    action='append', help='Number of days since start to process')    # noqa
     parser.add_argument('--state_file',       type=str,                help='Request all runs since state file\'s modification time and update time afterwards')  # noqa
     parser.add_argument('--create_state_file', action='store_true', help='Create a state file based on this invocation')
+    parser.add_argument('--watch',             action='store_true', help='Keep running, polling SmashRun for new runs since the last poll')  # noqa
     parser.add_argument('--no_coordinates',    action='store_true', help='Do not attempt to set coordinates for the entry')
     parser.add_argument('--no_strava',         action='store_true', help='Do not query Strava for photos or run routes')
     parser.add_argument('--no_badges',         action='store_true', help='Do not query SmasRun for badges')
-    parser.add_argument('--no_route',          action='store_true', help='Do not query SmasRun for badges')
+    parser.add_argument('--no_route',          action='store_true', help='Do not add a map of the route')
+    parser.add_argument('--concurrency',      type=int, default=CFG_CONCURRENCY, help='Number of activities to fetch in parallel')  # noqa
+    parser.add_argument('--rate_limit', dest='rate_limits', type=str, default=[], action='append', help='Per-service request limit of the form SERVICE=REQUESTS_PER_SEC')  # noqa
+    parser.add_argument('--cache_file',       type=str, default=CFG_CACHE_FILE, help='SQLite file caching SmashRun/Strava activity details')  # noqa
+    parser.add_argument('--image_store',      type=str, default=CFG_IMAGE_STORE_DIR, help='Directory holding downloaded badge images')  # noqa
+    parser.add_argument('--no_cache',          action='store_true', help='Do not read or write the activity cache or image store')  # noqa
+    parser.add_argument('--scratch_dir',      type=str, default=CFG_SCRATCH_DIR, help='Directory (e.g. /dev/shm) holding photos until their entry is written')  # noqa
+    parser.add_argument('--prefetch_badges',   action='store_true', help='Download images for every earned badge into the image store')  # noqa
+    parser.add_argument('--refresh',           action='store_true', help='Ignore cached activity details and fetch them again')  # noqa
+    parser.add_argument('--http_pool_size',   type=int, default=CFG_HTTP_POOL_SIZE, help='Number of keep-alive connections kept per host for downloads')  # noqa
+    parser.add_argument('--dayone_jobs',      type=int, default=CFG_DAYONE_JOBS, help='Number of dayone2 processes creating entries at once')  # noqa
+    parser.add_argument('--batch',            type=str,                help='Write all entries to this DayOne JSON import zip instead of running dayone2')  # noqa
+    parser.add_argument('--profile',           action='store_true', help='Log a per-stage timing and API call summary at exit')  # noqa
+    parser.add_argument('--profile_output',   type=str,                help='Also write the profile to this file (.prom for a Prometheus textfile, JSON otherwise)')  # noqa
     parser.add_argument('--dryrun',            action='store_true', help='Do not create journal entries. Just print the CLI commands to do so')  # noqa
     parser.add_argument('--debug',             action='store_true', help='Enable verbose debug')
-    args = parser.parse_args()
+    args = check_args(parser, parser.parse_args(argv))
+    args.name = None
+    args.athletes = []
+    if args.manifest:
+        args.athletes = parse_manifest(parser, argv, args.manifest)
+    return args
+
 
-    if not os.path.isfile(args.credentials_file):
+def parse_manifest(parser, argv, path):
+    # Each athlete is the command line plus their own options, given without the leading --
+    if not os.path.isfile(path):
+        parser.error('No such manifest: %s' % (path))
+    with open(path, 'r') as fh:
+        manifest = yaml.load(fh)
+
+    athletes = []
+    for idx, entry in enumerate((manifest or {}).get('athletes') or []):
+        entry = dict(entry)
+        name = entry.pop('name', None) or 'athlete %d' % (idx + 1)
+        options = []
+        for option, values in sorted(entry.items()):
+            if option in MANIFEST_SHARED_OPTIONS:
+                parser.error("Manifest entry %s: --%s applies to every athlete" % (name, option))
+            for value in (values if isinstance(values, list) else [values]):
+                if value is True:
+                    options.append('--%s' % (option))
+                elif value is not False and value is not None:
+                    options.extend(['--%s' % (option), '%s' % (value)])
+        athlete = parser.parse_args(argv + options)
+        athlete.manifest = None
+        athlete = check_args(parser, athlete)
+        athlete.name = name
+        athletes.append(athlete)
+
+    if len(athletes) == 0:
+        parser.error('No athletes in manifest %s' % (path))
+    return athletes
+
+
+def check_args(parser, args):
+    if args.credentials_file is None and not args.manifest:
+        parser.error('Must specify one of --credentials_file and --manifest')
+    if args.credentials_file is not None and not os.path.isfile(args.credentials_file):
         parser.error('No such credentials file: %s' % (args.credentials_file))
     if args.state_file and not os.path.isfile(args.state_file):
         parser.error('No such state file: %s' % (args.state_file))
@@ -104,7 +228,27 @@ def parse_args(argv):
         parser.error("Must specify at most one of --state_file and --days")
     if args.stop and args.days:
         parser.error("Must specify at most one of --stop and --days")
-
+    if args.prefetch_badges and (args.no_cache or args.no_badges):
+        parser.error("--prefetch_badges requires the image store and badges")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.dayone_jobs < 1:
+        parser.error("--dayone_jobs must be at least 1")
+    if args.watch and (args.stop or args.days or args.batch or args.command != 'run'):
+        parser.error("--watch can't be combined with --stop, --days, --batch or backfill")
+
+    rate_limits = dict(CFG_RATE_LIMITS)
+    for limit in args.rate_limits:
+        service, _, per_sec = limit.partition('=')
+        try:
+            rate_limits[service] = float(per_sec) if per_sec else None
+        except ValueError:
+            parser.error("Invalid --rate_limit %s: expected SERVICE=REQUESTS_PER_SEC" % (limit))
+    args.rate_limits = rate_limits
+
+    args.credentials = None
+    if args.credentials_file is None:
+        return args
     with open(args.credentials_file, 'r') as fh:
         setattr(args, 'credentials', yaml.load(fh))
         args.credentials.setdefault('smashrun', None)
@@ -123,18 +267,22 @@ def setup(argv):
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
 
+    configure_rate_limits(args.rate_limits)
+    configure_http(pool_size=args.http_pool_size)
+
+    for athlete in args.athletes or [args]:
+        setup_window(athlete)
+    return args
+
+
+def setup_window(args):
     to_zone = dateutil.tz.tzlocal()
 
+    args.processed = {}
+    args.processed_since = None
     if args.start is None:
         if args.state_file and not args.create_state_file:
-            tstamp = None
-            with open(args.state_file, 'r') as fh:
-                for line in fh.readlines():
-                    if line.startswith(STATE_FILE_PREFIX):
-                        tstamp = line[len(STATE_FILE_PREFIX):].rstrip()
-                        break
-            assert tstamp is not None, "Unable to determine last update time from %s" % (args.state_file)
-            args.start = datetime.strptime(tstamp, STATE_FILE_TIME_FORMAT)
+            args.start, args.processed, args.processed_since = state_file_window(args.state_file)
         else:
             # Use yesterday
             args.start = date.fromordinal(date.today().toordinal() - 1)
@@ -143,6 +291,8 @@ def setup(argv):
         fmt = '%Y-%m-%dT%H:%M:%S' if args.start.find('T') != -1 else '%Y-%m-%d'
         args.start = datetime.strptime(args.start, fmt)
     args.start = args.start.replace(tzinfo=to_zone)
+    # Every activity written since this point is in args.processed
+    args.processed_since = (args.processed_since or args.start).replace(tzinfo=to_zone)
 
     if args.stop is None:
         if args.days is None:
@@ -159,6 +309,92 @@ def setup(argv):
     return args
 
 
+def read_state_file(path):
+    state = {'stop': None, 'checkpoint': None, 'processed': {}, 'processed_since': None}
+    with open(path, 'r') as fh:
+        for line in fh.readlines():
+            line = line.rstrip()
+            if line.startswith(STATE_FILE_PREFIX) and state['stop'] is None:
+                state['stop'] = line[len(STATE_FILE_PREFIX):]
+            elif line.startswith(STATE_FILE_CHECKPOINT_PREFIX):
+                state['checkpoint'] = line[len(STATE_FILE_CHECKPOINT_PREFIX):]
+            elif line.startswith(STATE_FILE_PROCESSED_SINCE_PREFIX):
+                state['processed_since'] = line[len(STATE_FILE_PROCESSED_SINCE_PREFIX):]
+            elif line.startswith(STATE_FILE_PROCESSED_PREFIX):
+                activity_id, _, tstamp = line[len(STATE_FILE_PROCESSED_PREFIX):].partition(' ')
+                state['processed'][activity_id] = tstamp
+    return state
+
+
+def state_file_window(path):
+    # Where the next window starts, the activities already in the journal, and the time since which
+    # that list is complete (by default the last window's start, as only that window's are recorded)
+    state = read_state_file(path)
+    assert state['stop'] is not None, "Unable to determine last update time from %s" % (path)
+    start = datetime.strptime(state['stop'], STATE_FILE_TIME_FORMAT)
+    processed_since = datetime.strptime(state['processed_since'] or state['stop'], STATE_FILE_TIME_FORMAT)
+    if state['checkpoint'] is not None:
+        # Everything up to the checkpoint made it into the journal on a previous, interrupted run
+        start = max(start, datetime.strptime(state['checkpoint'], STATE_FILE_TIME_FORMAT))
+        logging.info("Resuming from checkpoint %s" % (start))
+    return start, state['processed'], processed_since
+
+
+def write_state_file(path, start, stop, processed=None, processed_since=None):
+    # Written aside and renamed into place so a crash never leaves a truncated state file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        fh.write("Command: %s\n" % (' '.join(sys.argv)))
+        fh.write("LastUpdateStart: %s\n" % (start.strftime(STATE_FILE_TIME_FORMAT)))
+        fh.write("%s%s\n" % (STATE_FILE_PREFIX, stop.strftime(STATE_FILE_TIME_FORMAT)))
+        if processed_since is not None:
+            fh.write("%s%s\n" % (STATE_FILE_PROCESSED_SINCE_PREFIX, processed_since.strftime(STATE_FILE_TIME_FORMAT)))
+        for activity_id, tstamp in sorted((processed or {}).items(), key=lambda item: item[1]):
+            fh.write("%s%s %s\n" % (STATE_FILE_PROCESSED_PREFIX, activity_id, tstamp))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp_path, path)
+
+
+class StateJournal(object):
+    # Appends each successfully written activity to the state file as it happens, along with a
+    # checkpoint covering the longest prefix of submitted runs that have all been written
+    def __init__(self, path, start, processed, processed_since=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.submitted = collections.deque()
+        self.written = set()
+        # Until this invocation finishes, the next one should start where this one did
+        write_state_file(path, start, start, processed, processed_since)
+        self.fh = open(path, 'a')
+
+    @staticmethod
+    def run_key(run):
+        tstamp = run['__localtime'].astimezone(dateutil.tz.tzlocal()).strftime(STATE_FILE_TIME_FORMAT)
+        return str(run['__id']['smashrun']), tstamp
+
+    def expect(self, run):
+        with self.lock:
+            self.submitted.append(self.run_key(run))
+
+    def record(self, run):
+        activity_id, tstamp = self.run_key(run)
+        with self.lock:
+            self.fh.write("%s%s %s\n" % (STATE_FILE_PROCESSED_PREFIX, activity_id, tstamp))
+            self.written.add(activity_id)
+            checkpoint = None
+            while len(self.submitted) > 0 and self.submitted[0][0] in self.written:
+                checkpoint = self.submitted.popleft()[1]
+            if checkpoint is not None:
+                self.fh.write("%s%s\n" % (STATE_FILE_CHECKPOINT_PREFIX, checkpoint))
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+
+
 def time_string(pace):
     SECS_PER_SEC = 1.0
     SECS_PER_MIN = SECS_PER_SEC * 60.0
@@ -178,20 +414,780 @@ def time_string(pace):
     return s
 
 
-def download_url(url):
-    r = requests.get(url)
-    if r.status_code == 200:
-        with tempfile.NamedTemporaryFile(prefix='dayonerun_strava_photo_', delete=False) as fh:
-            fh.write(r.content)
-            return fh.name
-    else:
-        logging.warning("Unable to download %s: %s" % (url, r.text))
+class Profiler(object):
+    FIELDS = ('calls', 'seconds', 'requests', 'bytes', 'retries')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def add(self, stage, **counts):
+        with self.lock:
+            stats = self.stages.setdefault(stage, dict.fromkeys(self.FIELDS, 0))
+            for field, value in counts.items():
+                stats[field] += value
+
+    def count(self, **counts):
+        # Attributed to the innermost stage running on this thread
+        stack = self.stack()
+        self.add(stack[-1] if len(stack) > 0 else 'other', **counts)
+
+    def report(self):
+        # Times are inclusive of nested stages, and stages running on worker threads overlap
+        lines = ['%-22s %8s %10s %9s %12s %8s' % ('Stage', 'Calls', 'Seconds', 'Requests', 'Bytes', 'Retries')]
+        with self.lock:
+            for stage, stats in self.stages.items():
+                lines.append('%-22s %8d %10.3f %9d %12d %8d' % (stage, stats['calls'], stats['seconds'],
+                                                                stats['requests'], stats['bytes'], stats['retries']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        with self.lock:
+            stages = dict((stage, dict(stats)) for stage, stats in self.stages.items())
+        with open(path, 'w') as fh:
+            if path.endswith('.prom'):
+                for field in self.FIELDS:
+                    metric = 'dayonerunlog_stage_%s_total' % (field)
+                    fh.write('# TYPE %s counter\n' % (metric))
+                    for stage, stats in sorted(stages.items()):
+                        fh.write('%s{stage="%s"} %s\n' % (metric, stage, stats[field]))
+            else:
+                json.dump({'timestamp': time.time(), 'stages': stages}, fh, indent=2, sort_keys=True)
+
+
+PROFILER = Profiler()
+
+
+def profiled_iter(stage, iterator):
+    # Generators only do their work as they're consumed, so time each step rather than the call
+    while True:
+        stack = PROFILER.stack()
+        stack.append(stage)
+        t0 = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stack.pop()
+            PROFILER.add(stage, seconds=time.time() - t0)
+        yield item
+
+
+def profiled(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            stack = PROFILER.stack()
+            stack.append(stage)
+            t0 = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                stack.pop()
+                PROFILER.add(stage, calls=1, seconds=time.time() - t0)
+            if isinstance(result, types.GeneratorType):
+                return profiled_iter(stage, result)
+            return result
+        return wrapper
+    return decorator
+
+
+class RateLimiter(object):
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+
+    def wait(self):
+        # Hand out evenly spaced slots so concurrent workers queue up rather than burst
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def configure_rate_limits(limits):
+    RATE_LIMITERS.clear()
+    for service, per_second in limits.items():
+        if per_second:
+            RATE_LIMITERS[service] = RateLimiter(per_second)
+
+
+def rate_limit(service):
+    limiter = RATE_LIMITERS.get(service)
+    if limiter is not None:
+        limiter.wait()
+
+
+def pool_map(pool, fn, items):
+    # Results come back in the order of items regardless of completion order
+    if pool is None:
+        return [fn(item) for item in items]
+    return pool.map(fn, items)
+
+
+class ImmediateResult(object):
+    def __init__(self, fn, args):
+        self.value = fn(*args)
+
+    def get(self):
+        return self.value
+
+
+def pool_apply(pool, fn, *args):
+    # apply_async, or just call fn without a pool. Either way the result comes from get().
+    if pool is None:
+        return ImmediateResult(fn, args)
+    return pool.apply_async(fn, args)
+
+
+def pool_imap(pool, fn, items, ahead):
+    # Lazy, ordered pool_map that keeps at most `ahead` items in flight, so results can be
+    # consumed (and released) while later ones are still being produced
+    if pool is None:
+        for item in items:
+            yield fn(item)
+        return
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def pool_stream(pool, fn, items, ahead, depth, discard=None):
+    # pool_imap for functions returning iterables, except that each one is handed back through a queue
+    # of at most `depth` results, so no worker gets further ahead of the consumer than that. Whatever
+    # is left over when the consumer stops early goes to `discard`.
+    if pool is None:
+        for item in items:
+            for result in fn(item):
+                yield result
+        return
+    cancelled = threading.Event()
+
+    def put(results, entry):
+        while not cancelled.is_set():
+            try:
+                results.put(entry, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def drain(results):
+        while True:
+            try:
+                result, error = results.get_nowait()
+            except Queue.Empty:
+                return
+            if result is not STREAM_END and discard is not None:
+                discard(result)
+
+    def produce(item, results):
+        try:
+            for result in fn(item):
+                if not put(results, (result, None)):
+                    if discard is not None:
+                        discard(result)
+                    break
+            else:
+                put(results, (STREAM_END, None))
+        except Exception as e:
+            put(results, (STREAM_END, e))
+        if cancelled.is_set():
+            drain(results)
+
+    items = iter(items)
+    streams = collections.deque()
+
+    def start_next():
+        for item in items:
+            results = Queue.Queue(depth)
+            pool.apply_async(produce, (item, results))
+            streams.append(results)
+            return
+
+    try:
+        for _ in range(ahead):
+            start_next()
+        while len(streams) > 0:
+            result, error = streams[0].get()
+            if result is STREAM_END:
+                if error is not None:
+                    raise error
+                streams.popleft()
+                start_next()
+                continue
+            yield result
+    finally:
+        cancelled.set()
+        for results in streams:
+            drain(results)
+
+
+class ActivityCache(object):
+    def __init__(self, path, ttl_in_days=CFG_CACHE_TTL_IN_DAYS, max_size_in_mb=CFG_CACHE_MAX_SIZE_IN_MB, refresh=False):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.ttl = ttl_in_days * 24 * 60 * 60
+        self.max_size = max_size_in_mb * 1024 * 1024
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Everything in here can be fetched again, so don't pay for a full sync on every insert
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS activities ('
+                            'service TEXT, id TEXT, payload BLOB, size INTEGER, stored REAL, accessed REAL, '
+                            'PRIMARY KEY (service, id))')
+
+    def get(self, service, activity_id):
+        if self.refresh:
+            return None
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute('SELECT payload, stored FROM activities WHERE service = ? AND id = ?',
+                                  (service, str(activity_id))).fetchone()
+            if row is None:
+                return None
+            if row[1] < now - self.ttl:
+                self.db.execute('DELETE FROM activities WHERE service = ? AND id = ?', (service, str(activity_id)))
+                return None
+            self.db.execute('UPDATE activities SET accessed = ? WHERE service = ? AND id = ?',
+                            (now, service, str(activity_id)))
+        logging.debug("Using cached %s activity %s" % (service, activity_id))
+        return json.loads(zlib.decompress(bytes(row[0])).decode('utf-8'))
+
+    def put(self, service, activity_id, payload):
+        blob = zlib.compress(json.dumps(payload).encode('utf-8'), 1)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?)',
+                            (service, str(activity_id), sqlite3.Binary(blob), len(blob), now, now))
+
+    def evict(self, now):
+        # Expired entries go first, then least recently used ones until we're under the size cap
+        self.db.execute('DELETE FROM activities WHERE stored < ?', (now - self.ttl,))
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM activities').fetchone()[0]
+        if total <= self.max_size:
+            return
+        victims = []
+        for service, activity_id, size in self.db.execute('SELECT service, id, size FROM activities ORDER BY accessed'):
+            if total <= self.max_size:
+                break
+            victims.append((service, activity_id))
+            total -= size
+        self.db.executemany('DELETE FROM activities WHERE service = ? AND id = ?', victims)
+
+    def close(self):
+        # Eviction scans the whole table, so it's done once per run rather than on every insert
+        with self.lock:
+            with self.db:
+                self.evict(time.time())
+            self.db.close()
+
+
+def cached_fetch(cache, service, activity_id, fetch_fn):
+    payload = None
+    if cache is not None:
+        payload = cache.get(service, activity_id)
+    if payload is None:
+        rate_limit(service)
+        PROFILER.count(requests=1)
+        payload = fetch_fn()
+        if cache is not None:
+            cache.put(service, activity_id, payload)
+    return payload
+
+
+class HttpClient(object):
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=CFG_HTTP_POOL_SIZE, retries=CFG_HTTP_RETRIES, timeout=CFG_HTTP_TIMEOUT_IN_SECS,
+                 backoff=0.5, max_delay=CFG_HTTP_MAX_RETRY_DELAY_IN_SECS):
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.session = requests.Session()
+        # Blocking on the pool caps concurrent connections per host at pool_size, however many threads download
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def retry_delay(self, response, attempt):
+        retry_after = None if response is None else response.headers.get('Retry-After')
+        if retry_after:
+            delay = None
+            if retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                parsed = email.utils.parsedate_tz(retry_after)
+                if parsed is not None:
+                    delay = max(0.0, email.utils.mktime_tz(parsed) - time.time())
+            if delay is not None:
+                if delay > self.max_delay:
+                    logging.warning("Waiting %ds rather than the %ds asked for by Retry-After: %s" % (
+                                    self.max_delay, delay, retry_after))
+                    delay = self.max_delay
+                return delay
+        # Exponential backoff with full jitter
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def get(self, url, service=None, stream=False, params=None, headers=None):
+        # Returns the final response (which may still be an error), or None if no response could be had
+        response = None
+        for attempt in range(self.retries + 1):
+            rate_limit(service)
+            PROFILER.count(requests=1, retries=1 if attempt > 0 else 0)
+            try:
+                response = self.session.get(url, timeout=self.timeout, stream=stream, params=params, headers=headers)
+                error = 'HTTP %s' % (response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = str(e)
+            if response is not None and response.status_code not in self.RETRY_STATUS_CODES:
+                return response
+            if attempt == self.retries:
+                break
+
+            delay = self.retry_delay(response, attempt)
+            if response is not None:
+                response.close()
+            logging.warning("Retrying %s in %.1fs after %s (attempt %d of %d)" % (
+                            url, delay, error, attempt + 1, self.retries))
+            time.sleep(delay)
+
+        logging.warning("Giving up on %s after %d attempts: %s" % (url, self.retries + 1, error))
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+def configure_http(**kwargs):
+    global HTTP_CLIENT
+    if HTTP_CLIENT is not None:
+        HTTP_CLIENT.close()
+    HTTP_CLIENT = HttpClient(**kwargs)
+
+
+def http_get(url, service=None, stream=False, params=None, headers=None):
+    if HTTP_CLIENT is None:
+        configure_http()
+    return HTTP_CLIENT.get(url, service=service, stream=stream, params=params, headers=headers)
+
+
+def stream_to_file(response, fh, max_bytes=None):
+    # Copies the body in fixed-size chunks so memory stays flat regardless of the image size
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise ValueError("Download exceeds %d bytes" % (max_bytes))
+        digest.update(chunk)
+        fh.write(chunk)
+    return size, digest.hexdigest()
+
+
+def download_to_tempfile(url, service=None, prefix='dayonerun_photo_', dir=None):
+    # Returns (filename, sha256) or (None, None)
+    max_bytes = None
+    if CFG_MAX_DOWNLOAD_SIZE_IN_MB is not None:
+        max_bytes = CFG_MAX_DOWNLOAD_SIZE_IN_MB * 1024 * 1024
+
+    r = http_get(url, service=service, stream=True)
+    if r is None:
+        logging.warning("Unable to download %s" % (url))
+        return None, None
+    try:
+        if r.status_code != 200:
+            logging.warning("Unable to download %s: %s" % (url, r.text))
+            return None, None
+        if max_bytes is not None and int(r.headers.get('Content-Length', 0)) > max_bytes:
+            logging.warning("Not downloading %s: %s bytes is over the limit of %d" % (url, r.headers['Content-Length'],
+                                                                                      max_bytes))
+            return None, None
+
+        with tempfile.NamedTemporaryFile(prefix=prefix, dir=dir, delete=False) as fh:
+            try:
+                size, checksum = stream_to_file(r, fh, max_bytes=max_bytes)
+            except (ValueError, requests.RequestException) as e:
+                logging.warning("Unable to download %s: %s" % (url, e))
+                fh.close()
+                os.unlink(fh.name)
+                return None, None
+        PROFILER.count(bytes=size)
+        logging.debug("Downloaded %s to %s (%d bytes, sha256 %s)" % (url, fh.name, size, checksum))
+        return fh.name, checksum
+    finally:
+        r.close()
+
+
+@profiled('download_url')
+def download_url(url, service=None, prefix='dayonerun_strava_photo_'):
+    fname, _ = download_to_tempfile(url, service=service, prefix=prefix, dir=scratch().path)
+    if fname is None:
+        return None
+    return scratch().claim(fname)
+
+
+class ScratchSpace(object):
+    # Every file handed to dayone2 lives in one directory per invocation, which is removed at exit
+    # whatever happens to the entries. Images from the store are hard links, so only downloads that
+    # bypass the store (or copies across filesystems) count towards the quota.
+    def __init__(self, root=None, quota_in_mb=CFG_SCRATCH_QUOTA_IN_MB):
+        if root is not None:
+            root = os.path.expanduser(root)
+            if not os.path.isdir(root):
+                os.makedirs(root)
+        self.path = tempfile.mkdtemp(prefix='dayonerun_', dir=root)
+        self.quota = None if quota_in_mb is None else quota_in_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.freed = threading.Condition(self.lock)
+        self.sizes = {}
+        self.used = 0
+        # Files of runs already handed to the writer, which are the only ones sure to be released soon
+        self.handed = set()
+        self.handed_bytes = 0
+
+    def mkstemp(self, prefix):
+        fd, fname = tempfile.mkstemp(prefix=prefix, dir=self.path)
+        os.close(fd)
+        return fname
+
+    def claim(self, fname):
+        # Over the quota, wait for entries being written to release their photos. Space held by runs
+        # still in the pipeline can't come free before this run is written, so past that the file is
+        # let in anyway: the pipeline depth bounds how far over the quota that goes.
+        st = os.stat(fname)
+        size = 0 if st.st_nlink > 1 else st.st_size
+        if self.quota is not None and size > self.quota:
+            os.unlink(fname)
+            raise RuntimeError("No room for %s: %d bytes is over the scratch space quota of %d bytes" % (
+                               fname, size, self.quota))
+        deadline = time.time() + SCRATCH_WAIT_IN_SECS
+        with self.lock:
+            while self.quota is not None and self.used + size > self.quota and self.handed_bytes > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning("Going over the scratch space quota of %d bytes: entries are slow to write" % (
+                                    self.quota))
+                    break
+                logging.debug("Waiting for scratch space for %s (%d of %d bytes used)" % (
+                              fname, self.used, self.quota))
+                self.freed.wait(remaining)
+            self.sizes[fname] = size
+            self.used += size
+        return fname
+
+    def hand_off(self, fnames):
+        # Called as a run goes to the writer. A run that can't fit in the quota on its own never will.
+        with self.lock:
+            size = sum(self.sizes.get(fname, 0) for fname in fnames)
+            if self.quota is not None and size > self.quota:
+                raise RuntimeError("No room for a run's %d bytes of photos: the scratch space quota is %d bytes" % (
+                                   size, self.quota))
+            for fname in fnames:
+                if fname in self.sizes and fname not in self.handed:
+                    self.handed.add(fname)
+                    self.handed_bytes += self.sizes[fname]
+
+    def link(self, blob, prefix):
+        # Each entry gets its own name for the image so releasing it never touches the store
+        fname = self.mkstemp(prefix)
+        os.unlink(fname)
+        try:
+            os.link(blob, fname)
+        except OSError:
+            shutil.copyfile(blob, fname)
+        return self.claim(fname)
+
+    def release(self, fname):
+        with self.lock:
+            size = self.sizes.pop(fname, 0)
+            self.used -= size
+            if fname in self.handed:
+                self.handed.remove(fname)
+                self.handed_bytes -= size
+            self.freed.notify_all()
+        if os.path.exists(fname):
+            os.unlink(fname)
+
+    def close(self):
+        if len(self.sizes) > 0:
+            logging.debug("Removing %d unreleased files from %s" % (len(self.sizes), self.path))
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.sizes = {}
+        self.used = 0
+        self.handed = set()
+        self.handed_bytes = 0
+
+
+def configure_scratch(**kwargs):
+    global SCRATCH
+    close_scratch()
+    SCRATCH = ScratchSpace(**kwargs)
+    return SCRATCH
+
+
+def close_scratch():
+    global SCRATCH
+    if SCRATCH is not None:
+        SCRATCH.close()
+        SCRATCH = None
+
+
+def scratch():
+    if SCRATCH is None:
+        configure_scratch()
+        atexit.register(close_scratch)
+    return SCRATCH
+
+
+class ImageStore(object):
+    # Images are stored once by content (sha256) and indexed by the URL they came from
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, sha256 TEXT)')
+
+    def blob_path(self, checksum):
+        return os.path.join(self.path, checksum[:2], checksum)
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT sha256 FROM images WHERE url = ?', (url,)).fetchone()
+        if row is not None and os.path.isfile(self.blob_path(row[0])):
+            return self.blob_path(row[0])
+        return None
+
+    def mkstemp(self, prefix):
+        # Files created here become blobs with a rename rather than a copy
+        fd, fname = tempfile.mkstemp(prefix=prefix, dir=self.path)
+        os.close(fd)
+        return fname
+
+    def add(self, url, fname, checksum):
+        blob = self.blob_path(checksum)
+        with self.lock:
+            if os.path.isfile(blob):
+                os.unlink(fname)
+            else:
+                if not os.path.isdir(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                shutil.move(fname, blob)
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?)', (url, checksum))
+        return blob
+
+    def fetch(self, url, service=None, key=None):
+        # key stands in for the URL in the index when the URL itself isn't stable
+        key = key or url
+        blob = self.lookup(key)
+        if blob is None:
+            fname, checksum = download_to_tempfile(url, service=service, prefix='dayonerun_image_', dir=self.path)
+            if fname is None:
+                return None
+            blob = self.add(key, fname, checksum)
+        return blob
+
+    def link_into(self, blob, prefix):
+        return scratch().link(blob, prefix)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def fetch_image(url, service=None, prefix='dayonerun_photo_', store=None, key=None):
+    if store is None:
+        return download_url(url, service=service, prefix=prefix)
+    blob = store.fetch(url, service=service, key=key)
+    if blob is None:
+        return None
+    return store.link_into(blob, prefix)
+
+
+def decode_polyline(polyline):
+    # Google's encoded polyline format: (lat, lng) deltas scaled by 1e5, each a zig-zag base64-ish varint
+    points = []
+    lat = lng = 0
+    idx = 0
+    try:
+        while idx < len(polyline):
+            deltas = []
+            for _ in range(2):
+                shift = result = 0
+                while True:
+                    b = ord(polyline[idx]) - 63
+                    idx += 1
+                    result |= (b & 0x1f) << shift
+                    shift += 5
+                    if b < 0x20:
+                        break
+                deltas.append(~(result >> 1) if result & 1 else result >> 1)
+            lat += deltas[0]
+            lng += deltas[1]
+            points.append((lat / 1e5, lng / 1e5))
+    except IndexError:
+        raise ValueError("Truncated polyline")
+    return points
+
+
+def project_route(points, size):
+    # Web Mercator, scaled to fill a size x size image (less a margin) without distorting the route
+    projected = []
+    for lat, lng in points:
+        if lat != lat or lng != lng:
+            continue  # Dropped GPS samples
+        lat = max(min(lat, 85.0), -85.0)
+        y = math.log(math.tan(math.pi / 4.0 + math.radians(lat) / 2.0))
+        projected.append((math.radians(lng), -y))
+    if len(projected) < 2:
+        return []
+
+    xs = [x for x, _ in projected]
+    ys = [y for _, y in projected]
+    margin = ROUTE_LINE_WIDTH * 2
+    span = max(max(xs) - min(xs), max(ys) - min(ys)) or 1e-9
+    scale = (size - 2 * margin - 1) / span
+    x_offset = (size - (max(xs) - min(xs)) * scale) / 2.0 - min(xs) * scale
+    y_offset = (size - (max(ys) - min(ys)) * scale) / 2.0 - min(ys) * scale
+    return [(x * scale + x_offset, y * scale + y_offset) for x, y in projected]
+
+
+def simplify_route(points, tolerance):
+    # Douglas-Peucker, with an explicit stack so long routes don't hit the recursion limit
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first]
+        x2, y2 = points[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        length = math.hypot(dx, dy)
+        max_distance = 0.0
+        max_idx = None
+        for idx in range(first + 1, last):
+            x, y = points[idx]
+            if length == 0.0:
+                distance = math.hypot(x - x1, y - y1)
+            else:
+                distance = abs(dy * (x - x1) - dx * (y - y1)) / length
+            if distance > max_distance:
+                max_distance = distance
+                max_idx = idx
+        if max_idx is not None and max_distance > tolerance:
+            keep[max_idx] = True
+            stack.append((first, max_idx))
+            stack.append((max_idx, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def rasterize_route(points, size):
+    # One palette index per pixel; the line is drawn by stamping squares along each segment
+    pixels = bytearray(size * size)
+
+    def stamp(x, y, color, width):
+        lo_x = max(int(x) - width // 2, 0)
+        hi_x = min(int(x) + (width + 1) // 2, size)
+        if lo_x >= hi_x:
+            return
+        fill = bytearray([color]) * (hi_x - lo_x)
+        for row in range(max(int(y) - width // 2, 0), min(int(y) + (width + 1) // 2, size)):
+            pixels[row * size + lo_x:row * size + hi_x] = fill
+
+    last = None
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        steps = int(max(abs(x1 - x0), abs(y1 - y0))) + 1
+        for step in range(steps + 1):
+            x = int(x0 + (x1 - x0) * step / float(steps))
+            y = int(y0 + (y1 - y0) * step / float(steps))
+            if (x, y) != last:
+                stamp(x, y, 1, ROUTE_LINE_WIDTH)
+                last = (x, y)
+    stamp(points[0][0], points[0][1], 2, ROUTE_LINE_WIDTH * 2)
+    stamp(points[-1][0], points[-1][1], 3, ROUTE_LINE_WIDTH * 2)
+    return pixels
+
+
+def encode_png(pixels, width, height, palette):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    # Each scanline is prefixed with filter type 0 (none)
+    raw = b''.join(b'\x00' + bytes(pixels[row * width:(row + 1) * width]) for row in range(height))
+    return (PNG_SIGNATURE +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)) +
+            chunk(b'PLTE', b''.join(struct.pack('BBB', *color) for color in palette)) +
+            chunk(b'IDAT', zlib.compress(raw, 9)) +
+            chunk(b'IEND', b''))
+
+
+def render_route_png(points, size=CFG_ROUTE_SIZE_IN_PIXELS, tolerance=CFG_ROUTE_TOLERANCE_IN_PIXELS):
+    projected = simplify_route(project_route(points, size), tolerance)
+    if len(projected) < 2:
+        return None
+    logging.debug("Drawing route with %d of %d points" % (len(projected), len(points)))
+    return encode_png(rasterize_route(projected, size), size, size, ROUTE_PALETTE)
+
+
+@profiled('render_route')
+def render_route_image(key, points, store=None, prefix='dayonerun_route_'):
+    # key identifies the route's source (a hash of its polyline or recording), so a route is only
+    # ever drawn once per size and tolerance
+    url = 'route:%s:%d:%s' % (key, CFG_ROUTE_SIZE_IN_PIXELS, CFG_ROUTE_TOLERANCE_IN_PIXELS)
+    if store is not None:
+        blob = store.lookup(url)
+        if blob is not None:
+            return store.link_into(blob, prefix)
+
+    png = render_route_png(points)
+    if png is None:
         return None
+    fname = scratch().mkstemp(prefix) if store is None else store.mkstemp(prefix)
+    with open(fname, 'wb') as fh:
+        fh.write(png)
+    if store is None:
+        return scratch().claim(fname)
+    return store.link_into(store.add(url, fname, hashlib.sha256(png).hexdigest()), prefix)
 
 
 def strava_client(client_id=None, client_secret=None, refresh_token=None, access_token=None):
+    from stravalib.client import Client
+
     client = Client()
-    if access_token is None:
+    if refresh_token is not None:
+        tokens = client.refresh_access_token(client_id=client_id, client_secret=client_secret,
+                                             refresh_token=refresh_token)
+        client.access_token = tokens['access_token']
+        client.token_expires_at = tokens['expires_at']
+        client.token_refresh_token = tokens['refresh_token']
+    elif access_token is None:
         authorize_url = client.authorization_url(client_id=client_id,
                                                  redirect_uri='http://localhost:8282/authorized',
                                                  scope='view_private,write')
@@ -207,94 +1203,206 @@ def strava_client(client_id=None, client_secret=None, refresh_token=None, access
     return client
 
 
-def st_get_photos(strava, activity_id):
-    # WORKAROUND until stravalib.get_activity_photos is fixed to include photo_sources
-    result_fetcher = functools.partial(strava.protocol.get,
-                                       '/activities/{id}/photos',
-                                       id=activity_id, photo_sources=True, size=CFG_STRAVA_PHOTO_SIZE)
-
-    return stravalib.client.BatchedResultsIterator(entity=stravalib.model.ActivityPhoto,
-                                                   bind_client=strava,
-                                                   result_fetcher=result_fetcher)
+def st_get_photos(strava, activity_id, cache=None):
+    # Returns [{'id', 'url'}] for the activity's photos. The listing is cached with its ETag/Last-Modified,
+    # so an activity whose photos haven't changed costs a 304.
+    cached = cache.get('strava_photos', activity_id) if cache is not None else None
+    headers = {'Authorization': 'Bearer %s' % (strava.access_token)}
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    url = '%s/activities/%s/photos' % (STRAVA_API_URL, activity_id)
+    r = http_get(url, service='strava', params={'photo_sources': 'true', 'size': CFG_STRAVA_PHOTO_SIZE},
+                 headers=headers)
+    if r is None:
+        return cached['photos'] if cached is not None else []
+    try:
+        if r.status_code == 304 and cached is not None:
+            logging.info("Photos for Strava activity %s are unchanged" % (activity_id))
+            return cached['photos']
+        if r.status_code != 200:
+            logging.warning("Unable to list photos for Strava activity %s: %s" % (activity_id, r.text))
+            return cached['photos'] if cached is not None else []
+
+        photos = []
+        for photo in r.json():
+            logging.debug("PHOTO: %s" % (photo))
+            photo_url = photo.get('urls', {}).get(str(CFG_STRAVA_PHOTO_SIZE))
+            if photo_url is not None:
+                photos.append({'id': photo.get('unique_id') or photo.get('ref') or photo_url, 'url': photo_url})
+        if cache is not None:
+            cache.put('strava_photos', activity_id, {'etag': r.headers.get('ETag'),
+                                                     'last_modified': r.headers.get('Last-Modified'),
+                                                     'photos': photos})
+        return photos
+    finally:
+        r.close()
 
 
+@profiled('st_get_runs')
 def st_get_runs(strava, start, stop):
     logging.info("Retriving Strava Runs START: %s" % (start))
     logging.info("                       STOP: %s" % (stop))
 
+    # Matching only needs start_date and distance, both of which are in the summaries, so page
+    # through those and leave the detail calls to st_get_activity for runs that actually match
     activities = []
-    for activity in strava.get_activities(after=start, before=stop):
-        raw = strava.protocol.get('/activities/{id}', id=activity.id, include_all_efforts=True)
-        activities.append(raw)
-        logging.debug("STRAVA_ACTIVITY(%s)=%s" % (activity.id, pprint.pformat(raw)))
+    page = 1
+    while True:
+        rate_limit('strava')
+        PROFILER.count(requests=1)
+        summaries = strava.protocol.get('/athlete/activities', after=epoch_seconds(start), before=epoch_seconds(stop),
+                                        page=page, per_page=STRAVA_PAGE_SIZE)
+        if not summaries:
+            break
+        for raw in summaries:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("STRAVA_ACTIVITY_SUMMARY(%s)=%s" % (raw['id'], pprint.pformat(raw)))
+            activities.append(raw)
+        page += 1
     return activities
 
 
-def st_find_strava_run(sr_run, st_runs):
-    from_zone = dateutil.tz.tzutc()
-    to_zone = dateutil.tz.tzlocal()
+def st_get_activity(strava, activity_id, cache=None):
+    fetch = functools.partial(strava.protocol.get, '/activities/{id}', id=activity_id, include_all_efforts=True)
+    raw = cached_fetch(cache, 'strava', activity_id, fetch)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("STRAVA_ACTIVITY(%s)=%s" % (activity_id, pprint.pformat(raw)))
+    return raw
 
-    for st_run in st_runs:
-        # 2016-11-17T15:59:56Z
-        utc = datetime.strptime(st_run['start_date'], '%Y-%m-%dT%H:%M:%SZ')
-        utc = utc.replace(tzinfo=from_zone)
-        local = utc.astimezone(to_zone)
-        st_time = local
-        st_distance = float(st_run['distance'])
-        sr_time = sr_run['__localtime']
+
+def epoch_seconds(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+class StravaRunIndex(object):
+    def __init__(self, st_runs):
+        entries = []
+        for st_run in st_runs:
+            # 2016-11-17T15:59:56Z
+            utc = datetime.strptime(st_run['start_date'], '%Y-%m-%dT%H:%M:%SZ')
+            entries.append((calendar.timegm(utc.timetuple()), float(st_run['distance']), st_run))
+        entries.sort(key=lambda entry: entry[0])
+
+        self.times = [entry[0] for entry in entries]
+        self.distances = [entry[1] for entry in entries]
+        self.runs = [entry[2] for entry in entries]
+        self.assigned = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.runs)
+
+    def match(self, sr_run):
+        sr_time = epoch_seconds(sr_run['__localtime'])
         sr_distance = float(sr_run['distance'] * 1000.0)
-        logging.debug("STRAVA: %s (%s) %s" % (st_time, local, st_distance))
-        logging.debug("SRUN  : %s (%s) %s" % (sr_time, sr_run['__localtime'], sr_distance))
-        logging.debug("   TIME (%s) (max: %s)" % (abs(st_time - sr_time), CFG_START_TIME_THRESHOLD_IN_SECS))
-        logging.debug("   DIST (%s) (max: %s)" % (abs(st_distance - sr_distance), CFG_DISTANCE_THRESHOLD_IN_METERS))
-        if abs(st_time - sr_time).total_seconds() < CFG_START_TIME_THRESHOLD_IN_SECS:
-            if abs(st_distance - sr_distance) < CFG_DISTANCE_THRESHOLD_IN_METERS:
-                return st_run
-            else:
-                logging.debug("Not matching %s and %s: distance %s is greater than threshold %s" % (sr_run['__id'],
-                                                                                                    st_run['id'],
-                                                                                                    abs(st_distance - sr_distance),
-                                                                                                    CFG_DISTANCE_THRESHOLD_IN_METERS))
-        else:
-            logging.debug("Not matching %s and %s: start time %s is greater than threshold %s" % (sr_run['__id'],
-                                                                                                 st_run['id'],
-                                                                                                 abs(st_time - sr_time),
-                                                                                                 CFG_START_TIME_THRESHOLD_IN_SECS))
 
-    return None
+        lo = bisect.bisect_right(self.times, sr_time - CFG_START_TIME_THRESHOLD_IN_SECS)
+        hi = bisect.bisect_left(self.times, sr_time + CFG_START_TIME_THRESHOLD_IN_SECS)
+
+        with self.lock:
+            best = None
+            best_score = None
+            for idx in range(lo, hi):
+                time_delta = abs(self.times[idx] - sr_time)
+                distance_delta = abs(self.distances[idx] - sr_distance)
+                logging.debug("   TIME (%s) (max: %s)" % (time_delta, CFG_START_TIME_THRESHOLD_IN_SECS))
+                logging.debug("   DIST (%s) (max: %s)" % (distance_delta, CFG_DISTANCE_THRESHOLD_IN_METERS))
+                if idx in self.assigned:
+                    logging.debug("Not matching %s and %s: already matched to another run" % (
+                                  sr_run['__id'], self.runs[idx]['id']))
+                    continue
+                if distance_delta >= CFG_DISTANCE_THRESHOLD_IN_METERS:
+                    logging.debug("Not matching %s and %s: distance %s is greater than threshold %s" % (
+                                  sr_run['__id'], self.runs[idx]['id'], distance_delta,
+                                  CFG_DISTANCE_THRESHOLD_IN_METERS))
+                    continue
+
+                # Both deltas are normalized by their thresholds so neither dominates the score
+                score = (float(time_delta) / CFG_START_TIME_THRESHOLD_IN_SECS +
+                         distance_delta / CFG_DISTANCE_THRESHOLD_IN_METERS)
+                if best is None or score < best_score:
+                    best = idx
+                    best_score = score
+
+            if best is None:
+                return None
+            self.assigned.add(best)
+            return self.runs[best]
+
+
+def st_find_strava_run(sr_run, st_index):
+    return st_index.match(sr_run)
+
+
+def st_get_route_image(polyline, google_maps_apikey=None, store=None):
+    if CFG_ROUTE_RENDERER == 'google':
+        poly = urllib.quote(polyline)
+        url = 'https://maps.googleapis.com/maps/api/staticmap?size=%dx%d&path=weight:%d%%7Ccolor:blue%%7Cenc:%s&key=%s' % (CFG_ROUTE_SIZE_IN_PIXELS, CFG_ROUTE_SIZE_IN_PIXELS, ROUTE_LINE_WIDTH, poly, google_maps_apikey)  # noqa
+        return download_url(url, service='google')
+    try:
+        points = decode_polyline(polyline)
+    except ValueError as e:
+        logging.warning("Unable to draw Strava route: %s" % (e))
+        return None
+    return render_route_image(hashlib.sha256(polyline.encode('utf-8')).hexdigest(), points, store=store)
+
+
+@profiled('st_get_route')
+def st_get_route(strava, activity_id, google_maps_apikey=None, cache=None, store=None):
+    # The full resolution polyline is only in the detailed activity
+    details = st_get_activity(strava, activity_id, cache=cache)
+    polyline = (details.get('map') or {}).get('polyline')
+    if not polyline:
+        return None
+    return st_get_route_image(polyline, google_maps_apikey, store=store)
+
 
+@profiled('st_get_photo')
+def st_get_photo(store, photo):
+    # Photo URLs can change between listings, so stored photos are keyed by their ID
+    key = 'strava-photo:%s:%d' % (photo['id'], CFG_STRAVA_PHOTO_SIZE)
+    return fetch_image(photo['url'], service='strava', prefix='dayonerun_strava_photo_', store=store, key=key)
 
-def st_append_strava_info(strava, sr_run, st_runs, args, google_maps_apikey=None):
-    st_run = st_find_strava_run(sr_run, st_runs)
-    if st_run is None:
-        logging.warning("Found no Strava run corresponding to SmashRun activity %s" % (sr_run['__id']['smashrun']))
+
+def st_match_runs(runs, st_index):
+    # Matching claims Strava activities one-to-one, so it's done here in order rather than on the workers
+    for sr_run in runs:
+        st_run = st_find_strava_run(sr_run, st_index)
+        if st_run is None:
+            logging.warning("Found no Strava run corresponding to SmashRun activity %s" % (sr_run['__id']['smashrun']))
+        else:
+            logging.info("Found Strava activity %s that matches SmashRun activity %s" % (
+                         st_run['id'], sr_run['__id']['smashrun']))
+            sr_run['__id']['strava'] = st_run['id']
+            sr_run['__tags'].append('strava')
+            sr_run['__activity_urls']['strava'] = 'https://www.strava.com/activities/%s' % (st_run['id'])
+        yield sr_run
+
+
+@profiled('st_append_strava_info')
+def st_append_strava_info(strava, sr_run, args, google_maps_apikey=None, cache=None, store=None, io_pool=None):
+    if 'strava' not in sr_run['__id']:
         return
-    logging.info("Found Strava activity %s that matches SmashRun activity %s" % (st_run['id'], sr_run['__id']['smashrun']))
+    activity_id = sr_run['__id']['strava']
 
-    sr_run['__id']['strava'] = st_run['id']
-    sr_run['__tags'].append('strava')
-    sr_run['__activity_urls']['strava'] = 'https://www.strava.com/activities/%s' % (st_run['id'])
+    # The route (details, then the map) and the photos (listing, then each download) don't depend on each
+    # other, so the route is fetched on the I/O pool while the photos are listed and downloaded in parallel
+    route = None
+    if not args.no_route and (CFG_ROUTE_RENDERER == 'local' or google_maps_apikey is not None):
+        route = pool_apply(io_pool, st_get_route, strava, activity_id, google_maps_apikey, cache, store)
 
-    # Add Strava route from polyline
-    polyline = None
-    if 'map' in st_run and 'polyline' in st_run['map']:
-        polyline = st_run['map']['polyline']
-    if not args.no_route and google_maps_apikey is not None and polyline:
-        poly = urllib.quote(polyline)
-        url = 'https://maps.googleapis.com/maps/api/staticmap?size=640x640&path=weight:6%%7Ccolor:blue%%7Cenc:%s&key=%s' % (poly, google_maps_apikey)  # noqa
-        fname = download_url(url)
-        if fname is not None:
-            sr_run['__photos'].append(fname)
-
-    # Add any Strava photos
-    logging.info("Getting any photos for %s" % (st_run['id']))
-    for photo in st_get_photos(strava, st_run['id']):
-        logging.debug("PHOTO: %s" % pprint.pformat(photo))
-        logging.debug("        ref : %s" % (photo.ref))
-        logging.debug("        urls: %s" % (pprint.pformat(photo.urls)))
-        fname = download_url(photo.urls[str(CFG_STRAVA_PHOTO_SIZE)])
-        if fname is not None:
-            sr_run['__photos'].append(fname)
+    logging.info("Getting any photos for %s" % (activity_id))
+    photos = pool_map(io_pool, functools.partial(st_get_photo, store), st_get_photos(strava, activity_id, cache=cache))
+
+    fname = route.get() if route is not None else None
+    if fname is not None:
+        sr_run['__photos'].append(fname)
+        sr_run['__route'] = True
+    sr_run['__photos'].extend(fname for fname in photos if fname is not None)
 
 
 def smashrun_client(client_id=None, client_secret=None, refresh_token=None, access_token=None):
@@ -307,48 +1415,133 @@ def smashrun_client(client_id=None, client_secret=None, refresh_token=None, acce
         raise RuntimeError("Must supply a token currently")
     else:
         client = Smashrun(client_id=client_id, client_secret=client_secret)
-        client.refresh_token(refresh_token=refresh_token)
+        token = client.refresh_token(refresh_token=refresh_token)
+        client.token_expires_at = token.get('expires_at')
+        client.token_refresh_token = token.get('refresh_token')
         return client
 
 
-def sr_get_split_info(details, split_interval=1.0 * UNITS.mile):
-    indices = {}
-    idx = 0
-    for key in details['recordingKeys']:
-        indices[key] = idx
-        idx += 1
+class ServiceClients(object):
+    # Authenticated clients that outlive a single window. Each is created on first use and only
+    # re-authenticated once its access token is about to expire.
+    def __init__(self, credentials):
+        self.credentials = dict((service, dict(creds) if isinstance(creds, dict) else creds)
+                                for service, creds in credentials.items())
+        self.clients = {}
+        self.factories = {'smashrun': smashrun_client, 'strava': strava_client}
+
+    def get(self, service):
+        client = self.clients.get(service)
+        expires_at = getattr(client, 'token_expires_at', None)
+        if client is None or (expires_at is not None and expires_at - TOKEN_EXPIRY_MARGIN_IN_SECS < time.time()):
+            if client is not None:
+                logging.info("Refreshing the %s access token" % (service))
+                # Refresh tokens may be single use
+                token = getattr(client, 'token_refresh_token', None)
+                if token is not None:
+                    self.credentials[service]['refresh_token'] = token
+            client = self.factories[service](**self.credentials[service])
+            self.clients[service] = client
+        return client
 
-    if indices.setdefault('distance', None) is None:
+    def smashrun(self):
+        return self.get('smashrun')
+
+    def strava(self):
+        return self.get('strava')
+
+
+class RecordingStream(object):
+    # The channels of a SmashRun recording that we actually use, each packed into an array of
+    # doubles rather than kept as lists of Python floats. Missing channels are None.
+    CHANNELS = ('distance', 'clock', 'latitude', 'longitude')
+
+    def __init__(self, details):
+        indices = dict((key, idx) for idx, key in enumerate(details.get('recordingKeys', [])))
+        values = details.get('recordingValues', [])
+        for channel in self.CHANNELS:
+            setattr(self, channel, self.pack(values[indices[channel]]) if channel in indices else None)
+
+    @staticmethod
+    def pack(values):
+        try:
+            return array.array('d', values)
+        except TypeError:
+            # Dropped samples come through as null
+            return array.array('d', [float('nan') if v is None else v for v in values])
+
+    def __len__(self):
+        return len(self.clock) if self.clock is not None else 0
+
+
+def sr_split_boundaries(distances, interval):
+    # Returns the sample index closing each split. A sample closes at most one split, so a
+    # distance jump spanning several intervals still only advances the threshold once.
+    boundaries = []
+    count = len(distances)
+    pairs = map(operator.le, itertools.islice(distances, 0, max(count - 1, 0)), itertools.islice(distances, 1, None))
+    if all(pairs):
+        idx = bisect.bisect_right(distances, interval)
+        while idx < count:
+            boundaries.append(idx)
+            idx = bisect.bisect_right(distances, interval * (len(boundaries) + 1), idx + 1)
+    else:
+        # Non-monotonic distances (GPS glitches) can't be bisected
+        for idx, distance in enumerate(distances):
+            if distance > interval * (len(boundaries) + 1):
+                boundaries.append(idx)
+    return boundaries
+
+
+def units():
+    # Building the registry parses all of pint's unit definitions. Quantities from different registries
+    # can't be mixed, so only one is ever built.
+    global UNITS
+    with UNITS_LOCK:
+        if UNITS is None:
+            from pint import UnitRegistry
+            UNITS = UnitRegistry()
+    return UNITS
+
+
+def sr_get_split_info(recording, split_interval=None):
+    if split_interval is None:
+        split_interval = 1.0 * units().mile
+    if recording.distance is None:
         return None
-    elif indices.setdefault('clock', None) is None:
+    elif recording.clock is None:
         return None
 
+    # pint is only consulted here to resolve the interval; everything below is plain floats
+    # in the interval's unit (distance) and seconds (time)
+    interval = split_interval.magnitude
+    interval_in_km = split_interval.to(units().kilometer).magnitude
+    km_to_interval_unit = (1.0 * units().kilometer).to(split_interval.units).magnitude
+
+    distances = recording.distance
+    clocks = recording.clock
+
     splits = []
-    element_idx = 0
-    last_split = element_idx
-    next_split = split_interval
-    prev_time = 0 * UNITS.second
-    prev_distance = 0
-    for distance in details['recordingValues'][indices['distance']]:
-        distance = distance * UNITS.kilometer
-        if distance > next_split:
-            cur_time = details['recordingValues'][indices['clock']][element_idx] * UNITS.second
-            splits.append({'total_distance': next_split,
-                           'split_distance': split_interval,
-                           'total_time': cur_time,
-                           'split_time': cur_time - prev_time
-                           })
-            prev_time = splits[-1]['total_time']
-            prev_distance = splits[-1]['total_distance']
-            next_split += split_interval
-            last_split = element_idx
-
-        element_idx += 1
+    last_split = 0
+    prev_time = 0.0
+    prev_distance = 0.0
+    next_split = interval
+    for element_idx in sr_split_boundaries(distances, interval_in_km):
+        cur_time = clocks[element_idx]
+        splits.append({'total_distance': next_split,
+                       'split_distance': interval,
+                       'total_time': cur_time,
+                       'split_time': cur_time - prev_time
+                       })
+        prev_time = cur_time
+        prev_distance = next_split
+        next_split += interval
+        last_split = element_idx
 
     # Figure out last part of split
-    if (last_split + 1) < len(details['recordingValues'][indices['distance']]):
-        last_total_distance = (details['recordingValues'][indices['distance']][-1] * UNITS.kilometer).to(UNITS.mile)
-        last_total_clock = details['recordingValues'][indices['clock']][-1] * UNITS.second
+    if (last_split + 1) < len(distances):
+        last_total_distance = distances[-1] * km_to_interval_unit
+        last_total_clock = clocks[-1]
         splits.append({'total_distance': last_total_distance,
                        'split_distance': last_total_distance - prev_distance,
                        'total_time': last_total_clock,
@@ -366,22 +1559,21 @@ def default_title(run):
     return 'SmashRun Activity on %s' % (run['__localtime'])
 
 
-def sr_get_coordinate(details):
-    indices = {}
-    idx = 0
-    for key in details['recordingKeys']:
-        indices[key] = idx
-        idx += 1
-
-    if indices.setdefault('latitude', None) is None:
+def sr_get_coordinate(recording):
+    if recording.latitude is None:
         return None
-    elif indices.setdefault('longitude', None) is None:
+    elif recording.longitude is None:
         return None
     else:
         # Just uses the last coordinate of the run
-        lat = details['recordingValues'][indices['latitude']][-1]
-        lng = details['recordingValues'][indices['longitude']][-1]
-        return (lat, lng)
+        return (recording.latitude[-1], recording.longitude[-1])
+
+
+def sr_get_route_image(recording, store=None):
+    if recording is None or recording.latitude is None or recording.longitude is None:
+        return None
+    key = hashlib.sha256(recording.latitude.tostring() + recording.longitude.tostring()).hexdigest()
+    return render_route_image(key, zip(recording.latitude, recording.longitude), store=store)
 
 
 def sr_get_userinfo(smashrun):
@@ -405,97 +1597,265 @@ def sr_get_badges(smashrun):
     return badges
 
 
-def sr_get_badge_photos(activity_id, badges):
+class BadgeIndex(object):
+    # Earned badges bucketed by the local date they were earned on
+    def __init__(self, badges):
+        self.zone = dateutil.tz.tzlocal()
+        self.days = collections.defaultdict(list)
+        for badge, localtime in badges:
+            self.days[self.day(localtime)].append((localtime, badge))
+
+    def day(self, localtime):
+        # Runs carry the offset of wherever they were, so compare dates in one zone
+        return localtime.astimezone(self.zone).date()
+
+    def lookup(self, localtime, prev_localtime=None, next_localtime=None):
+        # A badge belongs to the last run that day started before it was earned (or to the day's first
+        # run if it was earned before any of them), so runs on the same day never share a badge
+        day = self.day(localtime)
+        first_of_day = prev_localtime is None or self.day(prev_localtime) != day
+        last_of_day = next_localtime is None or self.day(next_localtime) != day
+        badges = []
+        for earned, badge in self.days.get(day, []):
+            if (first_of_day or earned >= localtime) and (last_of_day or earned < next_localtime):
+                badges.append(badge)
+        return badges
+
+
+def sr_badge_image_urls(badge):
+    # Returns the full size image URL followed by the normal size one
+    url = badge['image']
+    dirname, filename = os.path.split(url)
+    size_dir = os.path.basename(dirname)
+    if size_dir == 'medium':
+        size_dir = 'full'
+    full_url = '/'.join([os.path.dirname(dirname), size_dir, filename])
+    return full_url, url
+
+
+@profiled('sr_get_badge_photos')
+def sr_get_badge_photos(activity_id, badges, store=None):
     photos = []
     for badge in badges:
-        url = badge['image']
-        dirname, filename = os.path.split(url)
-        size_dir = os.path.basename(dirname)
-        if size_dir == 'medium':
-            size_dir = 'full'
-        full_url = '/'.join([os.path.dirname(dirname), size_dir, filename])
-
-        logging.info("Downloading full size image for %s" % (badge['name']))
-        request = requests.get(full_url)
-        tmpfile = tempfile.NamedTemporaryFile(prefix='dayonerun_%s_' % (activity_id), delete=False)
-        if request.status_code == 200:
-            tmpfile.write(request.content)
-            tmpfile.close()
-        else:
+        full_url, url = sr_badge_image_urls(badge)
+
+        prefix = 'dayonerun_%s_' % (activity_id)
+        fname = None
+        if store is not None:
+            # Either size will do if we already have it, rather than retrying a full size image that isn't there
+            blob = store.lookup(full_url) or store.lookup(url)
+            if blob is not None:
+                logging.info("Using stored image for %s" % (badge['name']))
+                fname = store.link_into(blob, prefix)
+
+        if fname is None:
+            logging.info("Downloading full size image for %s" % (badge['name']))
+            fname = fetch_image(full_url, service='smashrun', prefix=prefix, store=store)
+        if fname is None:
             logging.warning("Unable to download badge %s at %s. Trying normal size image." % (badge['name'], full_url))
-            request = requests.get(url)
-            if request.status_code != 200:
+            fname = fetch_image(url, service='smashrun', prefix=prefix, store=store)
+            if fname is None:
                 logging.warning("Unable to download badge %s at %s" % (badge['name'], url))
-                os.unlink(tmpfile)
-                tmpfile = None
-            else:
-                tmpfile.write(request.content)
-                tmpfile.close()
-        if tmpfile is not None:
-            photos.append(tmpfile.name)
+        if fname is not None:
+            photos.append(fname)
 
     return photos
 
 
-def sr_get_runs(smashrun, start, stop, userinfo, badges):
-    from_zone = dateutil.tz.tzutc()
-    to_zone = dateutil.tz.tzlocal()
+def sr_prefetch_badge_image(store, badge):
+    urls = sr_badge_image_urls(badge)
+    if any(store.lookup(url) is not None for url in urls):
+        return True
+    for url in urls:
+        if store.fetch(url, service='smashrun') is not None:
+            return True
+    logging.warning("Unable to prefetch image for badge %s" % (badge['name']))
+    return False
+
+
+def sr_prefetch_badge_images(store, badges, pool=None):
+    logging.info("Prefetching images for %d badges" % (len(badges)))
+    fetched = pool_map(pool, functools.partial(sr_prefetch_badge_image, store), [badge for badge, _ in badges])
+    logging.info("Image store holds %d of %d badge images" % (sum(fetched), len(badges)))
+
+
+@profiled('sr_fetch_activity')
+def sr_fetch_activity(smashrun, cache, store, activity):
+    details = cached_fetch(cache, 'smashrun', activity['activityId'],
+                           functools.partial(smashrun.get_activity, activity['activityId']))
+    # Recordings run to tens of thousands of samples, so only pretty print them when they'll be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("SMASHRUN_ACTIVITY(%s)=%s" % (activity['activityId'], pprint.pformat(details)))
+    # Only the packed channels outlive this call; the raw recording lists are dropped with details
+    activity['__recording'] = RecordingStream(details)
+    activity['__splits'] = sr_get_split_info(activity['__recording'])
+    activity['__coordinate'] = sr_get_coordinate(activity['__recording'])
+    activity['__photos'] = sr_get_badge_photos(activity['activityId'], activity['__badges'], store=store)
+    return activity
+
+
+def sr_parse_localtime(activity):
+    # 2016-11-17T07:11:00-08:00
+    dt = activity['startDateTimeLocal'][:-6]
+    tz = activity['startDateTimeLocal'][-6:]
+    offset = (int(tz[1:3]) * 60 * 60) + (int(tz[4:6]) * 60)
+    if tz[0] == '-':
+        offset = -offset
+    return datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=tzoffset(None, offset))
+
+
+def sr_search(smashrun, count=SMASHRUN_PAGE_SIZE, **params):
+    # The activity search, newest first. Pages are only requested as they're needed, and each one is
+    # charged to the SmashRun rate limit (the client's own get_activities pages without asking).
+    url = smashrun._build_url('my', 'activities', 'search')
+    page = 0
+    while True:
+        rate_limit('smashrun')
+        PROFILER.count(requests=1)
+        params.update(count=count, page=page)
+        response = smashrun.session.get(url, params=params)
+        response.raise_for_status()
+        activities = response.json()
+        if not activities:
+            return
+        for activity in activities:
+            yield activity
+        page += 1
 
-    logging.info("Retriving SmashRuns START: %s" % (start))
-    logging.info("                     STOP: %s" % (stop))
 
+def sr_search_window(smashrun, start, stop, count=SMASHRUN_PAGE_SIZE):
+    # Activities between start and stop, newest first. Like get_activities' since, the bounds are local times.
+    return sr_search(smashrun, count, fromDate=to_timestamp(start), toDate=to_timestamp(stop))
+
+
+@profiled('sr_has_activities')
+def sr_has_activities(smashrun, start, stop, skip_ids=None):
+    # The first page is usually enough to tell whether there's anything to do. Any run that comes back
+    # (even from outside the window, if it was ignored) means the full pass has to look, unless it's
+    # already in the journal. Walks, rides and the like are only ever dropped, so they don't count.
+    for r in sr_search_window(smashrun, start, stop, count=SMASHRUN_PAGE_SIZE):
+        if r['activityType'] == 'running' and (not skip_ids or str(r['activityId']) not in skip_ids):
+            return True
+    return False
+
+
+def sr_get_activities_since(smashrun, start, stop, seen):
+    # Everything since start comes back newest first, so anything after stop is downloaded only to be dropped
     activities = []
-    for r in smashrun.get_activities(since=start):
-        # 2016-11-17T07:11:00-08:00
-        dt = r['startDateTimeLocal'][:-6]
-        tz = r['startDateTimeLocal'][-6:]
-        offset = (int(tz[1:3]) * 60 * 60) + (int(tz[4:6]) * 60)
-        if tz[0] == '-':
-            offset = -offset
-
-        local = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=tzoffset(None, offset))
+    for r in sr_search(smashrun, fromDate=to_timestamp(start)):
+        local = sr_parse_localtime(r)
         if local > stop:
             logging.debug("Dropping activity on %s after stop date %s" % (local, stop))
-        else:
-            logging.info("Adding activity on %s" % (local))
+        elif r['activityId'] not in seen:
             activities.append((r, local))
     activities.reverse()
+    return activities
+
+
+def sr_iter_activities(smashrun, start, stop, until=None):
+    # Yields (activity, localtime) oldest first, one date slice at a time, so a backfill costs work in
+    # proportion to its window rather than to the time since start. Empty slices widen the next one.
+    # Slices are bounded by local start times, so only activities after until (default stop) are dropped.
+    until = until or stop
+    window = timedelta(days=CFG_SMASHRUN_WINDOW_IN_DAYS)
+    seen = set()
+    slice_start = start
+    while True:
+        slice_stop = min(slice_start + window, stop)
+        logging.debug("Retrieving SmashRuns from %s to %s" % (slice_start, slice_stop))
+        activities = []
+        for r in sr_search_window(smashrun, slice_start, slice_stop):
+            local = sr_parse_localtime(r)
+            if local > slice_stop + SMASHRUN_WINDOW_SLACK:
+                # The end of the window was ignored, so every slice would page through everything after it
+                logging.warning("SmashRun ignored the search window. Retrieving everything since %s" % (slice_start))
+                activities = sr_get_activities_since(smashrun, slice_start, until, seen)
+                slice_stop = stop
+                break
+            if local > until or r['activityId'] in seen:
+                continue
+            activities.append((r, local))
+        else:
+            activities.reverse()
+
+        for activity, local in activities:
+            logging.info("Adding activity on %s" % (local))
+            seen.add(activity['activityId'])
+            yield activity, local
+
+        if slice_stop >= stop:
+            return
+        slice_start = slice_stop
+        if activities:
+            window = timedelta(days=CFG_SMASHRUN_WINDOW_IN_DAYS)
+        else:
+            window = min(window * 2, timedelta(days=SMASHRUN_MAX_WINDOW_IN_DAYS))
+
 
-    results = []
+def sr_running_activities(activities):
     for activity, localtime in activities:
         if activity['activityType'] != 'running':
             logging.debug("Dropping non-running activity (%s) on %s" % (activity['activityType'], localtime))
             continue
-
-        logging.info("Adding %s from %s" % (activity['activityType'], localtime))
-        details = smashrun.get_activity(activity['activityId'])
-        logging.debug("SMASHRUN_ACTIVITY(%s)=%s" % (activity['activityId'], pprint.pformat(details)))
-        splits = sr_get_split_info(details)
-        activity['__id'] = {'smashrun': activity['activityId']}
-        activity['__activity_urls'] = {'smashrun': 'http://smashrun.com/%s/run/%s' % (userinfo['userName'],
-                                                                                      activity['activityId'])}
-        activity['__title_fn'] = CFG_ACTIVITY_TITLE_FN
-        activity['__notes'] = activity['notes'] + "\n"
-        activity['__localtime'] = localtime
-        activity['__tags'] = ['smashrun']
-        activity['__details'] = details
-        activity['__userinfo'] = userinfo
-        activity['__splits'] = splits
-        activity['__coordinate'] = sr_get_coordinate(details)
-        activity['__badges'] = []
-        min_badge_time = datetime.combine(localtime, datetime.min.time()).replace(tzinfo=to_zone)
-        max_badge_time = datetime.combine(localtime, datetime.max.time()).replace(tzinfo=to_zone)
-        for badge, badge_localtime in badges:
-            if badge_localtime >= min_badge_time and badge_localtime <= max_badge_time:
+        yield activity, localtime
+
+
+def sr_select_runs(activities, userinfo, badges, skip_ids=None, after=None, before=None):
+    # Runs starting outside after..before (in local wall clock time, as SmashRun searches) only count
+    # towards deciding which run each badge belongs to
+    badge_index = BadgeIndex(badges)
+    runs = sr_running_activities(activities)
+    prev_localtime = None
+    current = next(runs, None)
+    while current is not None:
+        activity, localtime = current
+        # Which of the day's badges are this run's depends on when the next run started
+        following = next(runs, None)
+        next_localtime = following[1] if following is not None else None
+
+        wallclock = localtime.replace(tzinfo=None)
+        if ((after is not None and wallclock < after.replace(tzinfo=None)) or
+                (before is not None and wallclock > before.replace(tzinfo=None))):
+            logging.debug("Not adding activity %s on %s: outside %s to %s" % (
+                          activity['activityId'], localtime, after, before))
+        elif skip_ids and str(activity['activityId']) in skip_ids:
+            logging.info("Skipping activity %s on %s: already in the journal" % (activity['activityId'], localtime))
+        else:
+            logging.info("Adding %s from %s" % (activity['activityType'], localtime))
+            activity['__id'] = {'smashrun': activity['activityId']}
+            activity['__activity_urls'] = {'smashrun': 'http://smashrun.com/%s/run/%s' % (userinfo['userName'],
+                                                                                          activity['activityId'])}
+            activity['__title_fn'] = CFG_ACTIVITY_TITLE_FN
+            activity['__notes'] = activity['notes'] + "\n"
+            activity['__localtime'] = localtime
+            activity['__tags'] = ['smashrun']
+            activity['__userinfo'] = userinfo
+            activity['__badges'] = badge_index.lookup(localtime, prev_localtime, next_localtime)
+            for badge in activity['__badges']:
                 logging.info("Adding badge %s to run ID %s on %s" % (badge['name'], activity['activityId'], localtime))
-                activity['__badges'].append(badge)
+            yield activity
 
-        activity['__photos'] = []
-        activity['__photos'] = sr_get_badge_photos(activity['activityId'], activity['__badges'])
+        prev_localtime = localtime
+        current = following
 
-        results.append(activity)
 
-    return results
+@profiled('sr_get_runs')
+def sr_get_runs(smashrun, start, stop, userinfo, badges, pool=None, cache=None, store=None, ahead=CFG_CONCURRENCY,
+                skip_ids=None, until=None):
+    logging.info("Retriving SmashRuns START: %s" % (start))
+    logging.info("                     STOP: %s" % (stop))
+
+    # Detail fetches and badge downloads are independent per activity, so fan them out. Runs are
+    # yielded in chronological order as each date slice arrives rather than collected up front.
+    # A window starting or ending part way through a day also needs that day's other runs, or its first
+    # and last runs would take badges that belong to runs in the neighbouring windows
+    zone = dateutil.tz.tzlocal()
+    day_start = start.astimezone(zone).replace(hour=0, minute=0, second=0, microsecond=0)
+    day_end = stop.astimezone(zone).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    activities = sr_iter_activities(smashrun, min(day_start, start), max(day_end, stop),
+                                    until=max(day_end, until or stop))
+    runs = sr_select_runs(activities, userinfo, badges, skip_ids=skip_ids, after=start, before=stop)
+    return pool_imap(pool, functools.partial(sr_fetch_activity, smashrun, cache, store), runs, ahead)
 
 
 def gen_split_markdown(splits):
@@ -503,17 +1863,16 @@ def gen_split_markdown(splits):
     table += 'Distance | Total Time | Split Time | Split Pace | Total Pace\n'
     table += '-------- | ---------- | ---------- | ---------- | ----------\n'
     for split in splits:
-        table += '%.2f | ' % (split['total_distance'].magnitude)
-        table += '%s | ' % (time_string(split['total_time'].magnitude))
-        table += '%s | ' % (time_string(split['split_time'].magnitude))
-        table += '%s | ' % (time_string(split['split_pace'].magnitude))
-        table += '%s\n' % (time_string(split['total_pace'].magnitude))
+        table += '%.2f | ' % (split['total_distance'])
+        table += '%s | ' % (time_string(split['total_time']))
+        table += '%s | ' % (time_string(split['split_time']))
+        table += '%s | ' % (time_string(split['split_pace']))
+        table += '%s\n' % (time_string(split['total_pace']))
     table += '\n'
     return table
 
 
-def create_journal_entry(args, run):
-    split_markdown = gen_split_markdown(run['__splits'])
+def gen_dayone_args(args, run):
     dayone_args = ['dayone2']
 
     if args.journal is not None:
@@ -522,7 +1881,7 @@ def create_journal_entry(args, run):
     dayone_args.extend(['--date', run['__localtime'].strftime('%Y-%m-%d %H:%M:%S')])
 
     # Our tag + run-specific tags + command line tags
-    dayone_args.extend(['--tags', 'dayonerun'] + run['__tags'] + args.tags)
+    dayone_args.extend(['--tags'] + gen_entry_tags(args, run))
 
     if not args.no_coordinates and run['__coordinate'] is not None:
         dayone_args.extend(['--coordinate', str(run['__coordinate'][0]), str(run['__coordinate'][1])])
@@ -534,8 +1893,15 @@ def create_journal_entry(args, run):
     dayone_args.append('--')
     dayone_args.append('new')
 
-    dayone_args = ["'%s'" % (x) if ' ' in x else x for x in dayone_args]
-    logging.info("Invoking: %s" % (' '.join(dayone_args)))
+    return ["'%s'" % (x) if ' ' in x else x for x in dayone_args]
+
+
+def gen_entry_tags(args, run):
+    return ['dayonerun'] + run['__tags'] + args.tags
+
+
+def gen_entry_text(run):
+    split_markdown = gen_split_markdown(run['__splits'])
 
     title_fn = run['__title_fn']
     if title_fn is None:
@@ -559,6 +1925,15 @@ def create_journal_entry(args, run):
 
         entry_text += '   * [%s Link](%s)%s\n' % (service_map[service], url, ident)
 
+    return entry_text
+
+
+@profiled('create_journal_entry')
+def create_journal_entry(args, run):
+    dayone_args = gen_dayone_args(args, run)
+    logging.info("Invoking: %s" % (' '.join(dayone_args)))
+    entry_text = run.get('__entry_text') or gen_entry_text(run)
+
     if args.dryrun or args.debug:
         logging.info("Entry text:\n" + entry_text)
         if args.dryrun:
@@ -579,41 +1954,453 @@ def create_journal_entry(args, run):
         logging.info("Created journal entry successfully")
 
 
-def cleanup_runs(runs):
-    for run in runs:
-        for photo in run['__photos']:
-            logging.info("Deleting temp photo %s" % (photo))
-            os.unlink(photo)
+def write_journal_entry(args, run, on_written=None):
+    try:
+        create_journal_entry(args, run)
+        if on_written is not None and not args.dryrun:
+            on_written(run)
+    finally:
+        release_run(run)
+
+
+class JournalWriter(object):
+    # Runs dayone2 in the background so the next run can be collected and enriched while the
+    # current entry is being created
+    def __init__(self, args, jobs=CFG_DAYONE_JOBS, on_written=None):
+        self.args = args
+        self.on_written = on_written
+        self.pool = ThreadPool(jobs)
+        self.max_pending = jobs * 2
+        self.pending = collections.deque()
+
+    def reap(self, limit):
+        # get() re-raises any failure from create_journal_entry here in the caller
+        while len(self.pending) > limit:
+            self.pending.popleft().get()
+
+    def submit(self, run):
+        self.reap(self.max_pending - 1)
+        self.pending.append(self.pool.apply_async(write_journal_entry, (self.args, run, self.on_written)))
+
+    def close(self):
+        try:
+            self.reap(0)
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+class BatchJournalWriter(object):
+    # Writes every entry into one DayOne JSON import zip instead of spawning dayone2 per entry
+    IMAGE_TYPES = ((b'\x89PNG', 'png'), (b'\xff\xd8', 'jpeg'), (b'GIF8', 'gif'))
+
+    def __init__(self, args, path, on_written=None):
+        self.args = args
+        self.path = path
+        self.on_written = on_written
+        self.runs = []
+        self.entries = []
+        self.written = set()
+        self.zip = None
+        if not args.dryrun:
+            self.path = self.unused_path(path)
+            self.zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    @staticmethod
+    def unused_path(path):
+        # A resumed run must never truncate the zip holding the entries its state file says are done, so
+        # each invocation gets a fresh FILE-N.zip alongside any earlier one
+        root, ext = os.path.splitext(path)
+        idx = 0
+        while True:
+            candidate = path if idx == 0 else '%s-%d%s' % (root, idx, ext)
+            try:
+                fd = os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                idx += 1
+                continue
+            os.close(fd)
+            if candidate != path:
+                logging.info("%s already exists, writing entries to %s instead" % (path, candidate))
+            return candidate
+
+    def add_photo(self, fname):
+        digest = hashlib.md5()
+        with open(fname, 'rb') as fh:
+            header = fh.read(8)
+            fh.seek(0)
+            for chunk in iter(functools.partial(fh.read, DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        photo_type = 'jpeg'
+        for magic, image_type in self.IMAGE_TYPES:
+            if header.startswith(magic):
+                photo_type = image_type
+                break
+
+        md5 = digest.hexdigest()
+        if md5 not in self.written:
+            self.zip.write(fname, 'photos/%s.%s' % (md5, photo_type))
+            self.written.add(md5)
+        return {'identifier': uuid.uuid4().hex.upper(), 'md5': md5, 'type': photo_type}
+
+    def submit(self, run):
+        try:
+            self.add_entry(run)
+        finally:
+            release_run(run)
+
+    def add_entry(self, run):
+        entry_text = run.get('__entry_text') or gen_entry_text(run)
+        entry = {'uuid': uuid.uuid4().hex.upper(),
+                 'creationDate': run['__localtime'].astimezone(dateutil.tz.tzutc()).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'tags': gen_entry_tags(self.args, run),
+                 'starred': False}
+        if not self.args.no_coordinates and run['__coordinate'] is not None:
+            entry['location'] = {'latitude': run['__coordinate'][0], 'longitude': run['__coordinate'][1]}
+
+        logging.info("Adding entry for %s to %s" % (run['__localtime'], self.path))
+        if self.args.dryrun or self.args.debug:
+            logging.info("Entry text:\n" + entry_text)
+            if self.args.dryrun:
+                return
+
+        photos = []
+        for idx, fname in enumerate(run['__photos']):
+            photo = self.add_photo(fname)
+            photo['orderInEntry'] = idx
+            photos.append(photo)
+        if len(photos) > 0:
+            entry['photos'] = photos
+            moments = ''.join(['![](dayone-moment://%s)\n' % (photo['identifier']) for photo in photos])
+            entry_text = moments + entry_text
+        entry['text'] = entry_text
+        self.entries.append(entry)
+        self.runs.append(run)
+
+    def close(self):
+        if self.zip is None:
+            return
+        # DayOne names the imported journal after the JSON file
+        journal = {'metadata': {'version': '1.0'}, 'entries': self.entries}
+        self.zip.writestr('%s.json' % (self.args.journal or 'Journal'), json.dumps(journal, indent=2))
+        self.zip.close()
+        logging.info("Wrote %d entries to %s" % (len(self.entries), self.path))
+
+        # Nothing is durable until the zip is complete
+        if self.on_written is not None:
+            for run in self.runs:
+                self.on_written(run)
+
+
+def release_run(run):
+    # Everything a run holds on to beyond what its entry needs, once that entry is written
+    for photo in run['__photos']:
+        logging.debug("Deleting scratch photo %s" % (photo))
+        scratch().release(photo)
+    run['__photos'] = []
+    run.pop('__recording', None)
+    run.pop('__entry_text', None)
+
+
+def enrich_run(args, strava, cache, store, io_pool, run):
+    if strava is not None:
+        st_append_strava_info(strava, run, args, args.credentials['google_maps_apikey'], cache=cache, store=store,
+                              io_pool=io_pool)
+    if not args.no_route and not run.get('__route') and CFG_ROUTE_RENDERER == 'local':
+        # No route from Strava, so draw the one SmashRun recorded
+        fname = sr_get_route_image(run.get('__recording'), store=store)
+        if fname is not None:
+            run['__photos'].append(fname)
+            run['__route'] = True
+    return run
 
 
-def main(args):
-    runs = []
+def enrich_runs(runs, args, strava=None, st_index=None, cache=None, store=None, pool=None, io_pool=None,
+                ahead=CFG_CONCURRENCY):
+    # Everything after matching is network-bound, so up to `ahead` runs are enriched at once
+    if strava is not None:
+        runs = st_match_runs(runs, st_index)
+    return pool_imap(pool, functools.partial(enrich_run, args, strava, cache, store, io_pool), runs, ahead)
+
+
+def render_runs(runs):
+    for run in runs:
+        run['__entry_text'] = gen_entry_text(run)
+        # The recording streams are only needed for splits/coordinates (and possibly the title)
+        run.pop('__recording', None)
+        yield run
+
+
+def backfill_shards(start, stop):
+    # [start, stop] split at month boundaries
+    shards = []
+    shard_start = start
+    while True:
+        next_month = (shard_start.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0,
+                                                                               microsecond=0)
+        shard_stop = min(next_month, stop)
+        shards.append((shard_start, shard_stop))
+        if shard_stop >= stop:
+            return shards
+        shard_start = shard_stop
+
+
+def backfill_shard(args, smashrun, userinfo, badges, strava, st_index, cache, store, io_pool, shard):
+    shard_start, shard_stop = shard
+    logging.info("Backfilling %s to %s" % (shard_start, shard_stop))
+    sr_runs = sr_get_runs(smashrun, shard_start, shard_stop, userinfo, badges, cache=cache, store=store,
+                          skip_ids=args.processed, until=args.stop)
+    return render_runs(enrich_runs(sr_runs, args, strava=strava, st_index=st_index, cache=cache, store=store,
+                                   io_pool=io_pool))
+
+
+def backfill_runs(args, smashrun, userinfo, badges, strava=None, st_index=None, pool=None, cache=None, store=None,
+                  io_pool=None):
+    # Each month is fetched and enriched on its own worker, all drawing on the same per-service rate
+    # limits, and the months are merged back in chronological order for writing. A month waiting its
+    # turn only holds a few rendered runs (and their scratch photos) rather than the whole month.
+    fn = functools.partial(backfill_shard, args, smashrun, userinfo, badges, strava, st_index, cache, store, io_pool)
+    seen = set()
+    for run in pool_stream(pool, fn, backfill_shards(args.start, args.stop), args.concurrency, args.concurrency,
+                           discard=release_run):
+        # A run starting exactly on a month boundary is found by both months
+        if run['__id']['smashrun'] in seen:
+            release_run(run)
+            continue
+        seen.add(run['__id']['smashrun'])
+        yield run
+
+
+class Workspace(object):
+    # Worker pools, the activity cache, the image store and scratch space. Nothing is set up until
+    # a window actually has activities, and every window opened with it shares the one set.
+    def __init__(self, args):
+        self.args = args
+        self.opened = False
+        self.pool = None
+        self.io_pool = None
+        self.cache = None
+        self.store = None
+
+    def open(self):
+        if self.opened:
+            return self
+        self.opened = True
+        args = self.args
+        if args.concurrency > 1:
+            self.pool = ThreadPool(args.concurrency)
+            # Each run's downloads fan out here; the HTTP pool caps how many hit one host at once
+            self.io_pool = ThreadPool(args.http_pool_size)
+        if not args.no_cache:
+            self.cache = ActivityCache(args.cache_file, refresh=args.refresh)
+            self.store = ImageStore(args.image_store)
+        scratch_dir = args.scratch_dir
+        if scratch_dir is None and self.store is not None:
+            # Beside the blobs, so photos are hard links rather than copies
+            scratch_dir = os.path.join(self.store.path, 'scratch')
+        configure_scratch(root=scratch_dir)
+        return self
+
+    def close(self):
+        for workers in (self.pool, self.io_pool):
+            if workers is not None:
+                workers.close()
+                workers.join()
+        if self.cache is not None:
+            self.cache.close()
+        if self.store is not None:
+            self.store.close()
+        if self.opened:
+            # Whatever wasn't released (a failed entry, a dry run of a batch) goes with the directory
+            close_scratch()
+        self.opened = False
+        self.pool = None
+        self.io_pool = None
+        self.cache = None
+        self.store = None
+
+
+def process_window(args, clients, workspace=None):
+    # Returns how many runs were handed to the writer
+    count = 0
+    writer = None
+    journal = None
+    pipeline = None
+    owned = workspace is None
+    if owned:
+        workspace = Workspace(args)
+    start = args.start
+    kept, kept_since = None, None
+    if args.watch:
+        # Runs are only uploaded once they finish, so one that started before the last poll can still
+        # turn up. Reach back as far as the processed list can vouch for, and let it skip what's written.
+        start = max(args.start - timedelta(hours=CFG_WATCH_LOOKBACK_IN_HOURS), args.processed_since)
+        cutoff = start.strftime(STATE_FILE_TIME_FORMAT)
+        args.processed = dict(item for item in args.processed.items() if item[1] >= cutoff)
+        args.processed_since = start
+        kept, kept_since = args.processed, start
     try:
-        smashrun = smashrun_client(**args.credentials['smashrun'])
+        smashrun = clients.smashrun()
+        # A badge prefetch is wanted whether or not there are new runs
+        if not args.prefetch_badges and not sr_has_activities(smashrun, start, args.stop, skip_ids=args.processed):
+            # Most polls end here, before any worker, cache, Strava, badge or unit setup
+            logging.info("No new SmashRun activities between %s and %s" % (start, args.stop))
+            if args.state_file or args.create_state_file:
+                write_state_file(args.state_file, args.start, args.stop, kept, kept_since)
+            return count
+
+        workspace.open()
+        pool, io_pool, cache, store = workspace.pool, workspace.io_pool, workspace.cache, workspace.store
         userinfo = sr_get_userinfo(smashrun)
         badges = []
         if not args.no_badges:
             badges = sr_get_badges(smashrun)
-        sr_runs = sr_get_runs(smashrun, args.start, args.stop, userinfo, badges)
+            if args.prefetch_badges and store is not None:
+                sr_prefetch_badge_images(store, badges, pool=pool)
+                # Once is enough. A badge earned later arrives with a run, which downloads its image anyway.
+                args.prefetch_badges = False
 
+        strava = None
+        st_index = None
         if not args.no_strava:
-            strava = strava_client(**args.credentials['strava'])
-            st_runs = st_get_runs(strava, args.start, args.stop)
+            strava = clients.strava()
+            st_index = StravaRunIndex(st_get_runs(strava, start, args.stop))
+
+        if args.state_file and not args.dryrun:
+            journal = StateJournal(args.state_file, args.start, args.processed, kept_since)
+
+        def on_written(run):
+            activity_id, tstamp = StateJournal.run_key(run)
+            args.processed[activity_id] = tstamp
+            if journal is not None:
+                journal.record(run)
+        if args.batch:
+            writer = BatchJournalWriter(args, args.batch, on_written=on_written)
+        else:
+            writer = JournalWriter(args, jobs=args.dayone_jobs, on_written=on_written)
 
-        for run in sr_runs:
-            if not args.no_strava:
-                st_append_strava_info(strava, run, st_runs, args, args.credentials['google_maps_apikey'])
-            create_journal_entry(args, run)
+        # fetch -> enrich -> render -> write, one run at a time. Each run is released by the
+        # writer as soon as its entry exists.
+        if args.command == 'backfill':
+            pipeline = backfill_runs(args, smashrun, userinfo, badges, strava=strava, st_index=st_index, pool=pool,
+                                     cache=cache, store=store, io_pool=io_pool)
+        else:
+            sr_runs = sr_get_runs(smashrun, start, args.stop, userinfo, badges, pool=pool, cache=cache,
+                                  store=store, ahead=args.concurrency, skip_ids=args.processed)
+            pipeline = render_runs(enrich_runs(sr_runs, args, strava=strava, st_index=st_index, cache=cache,
+                                               store=store, pool=pool, io_pool=io_pool, ahead=args.concurrency))
+        for run in pipeline:
+            scratch().hand_off(run['__photos'])
+            if journal is not None:
+                journal.expect(run)
+            writer.submit(run)
+            count += 1
+        writer.close()
+        writer = None
 
         if args.state_file or args.create_state_file:
-            with open(args.state_file, 'w') as fh:
-                fh.write("Command: %s\n" % (' '.join(sys.argv)))
-                fh.write("LastUpdateStart: %s\n" % (args.start.strftime(STATE_FILE_TIME_FORMAT)))
-                fh.write("%s%s\n" % (STATE_FILE_PREFIX, args.stop.strftime(STATE_FILE_TIME_FORMAT)))
+            if journal is not None:
+                journal.close()
+                journal = None
+            # The whole window is done, so the per-activity journal is only needed for what a watch reaches back over
+            write_state_file(args.state_file, args.start, args.stop, kept, kept_since)
+
+    finally:
+        if pipeline is not None:
+            # Stops any backfill months still being fetched before their workers are shut down
+            pipeline.close()
+        if writer is not None:
+            # Only reached on failure. Let in-flight entries finish without masking the original error.
+            try:
+                writer.close()
+            except Exception as e:
+                logging.error("Unable to finish pending journal entries: %s" % (e))
+        if journal is not None:
+            journal.close()
+        if owned:
+            workspace.close()
+
+    return count
+
+
+def report_profile(args):
+    if args.profile:
+        logging.info("Profile:\n" + PROFILER.report())
+    if args.profile_output:
+        PROFILER.dump(args.profile_output)
+
+
+def process_athlete(args, clients, workspace):
+    # Returns the athlete's run count, or None if their window failed. Either way the athlete is left
+    # ready for their next window, and nobody else is affected.
+    if args.name is not None:
+        logging.info("Processing %s" % (args.name))
+    try:
+        count = process_window(args, clients, workspace)
+    except Exception as e:
+        athlete = '' if args.name is None else ' for %s' % (args.name)
+        logging.exception("Unable to process %s to %s%s: %s" % (args.start, args.stop, athlete, e))
+        if args.state_file and not args.dryrun:
+            # Pick up from whatever the failed window got into the journal
+            args.start, args.processed, args.processed_since = state_file_window(args.state_file)
+            args.start = args.start.replace(tzinfo=dateutil.tz.tzlocal())
+            args.processed_since = args.processed_since.replace(tzinfo=dateutil.tz.tzlocal())
+        return None
+    # A watch keeps what it wrote, as the next window reaches back over it
+    args.start = args.stop
+    return count
+
 
+def process_athletes(args, athletes):
+    workspace = Workspace(args)
+    try:
+        return [process_athlete(athlete, clients, workspace) for athlete, clients in athletes]
     finally:
-        cleanup_runs(runs)
+        workspace.close()
+        report_profile(args)
+
+
+def watch(args, athletes):
+    # Polls every athlete from the end of their last window that went through. The interval doubles
+    # while polls come back empty (or fail) and drops back to the minimum as soon as a run turns up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    interval = None
+    try:
+        while True:
+            now = datetime.now(dateutil.tz.tzlocal())
+            for athlete, _ in athletes:
+                athlete.stop = now
+            counts = process_athletes(args, athletes)
+
+            if any(counts) or interval is None:
+                interval = CFG_WATCH_MIN_INTERVAL_IN_SECS
+            else:
+                interval = min(interval * 2, CFG_WATCH_MAX_INTERVAL_IN_SECS)
+            logging.info("Next poll in %ds" % (interval))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")
+    return 0
 
+
+def main(args):
+    athletes = [(athlete, ServiceClients(athlete.credentials)) for athlete in args.athletes or [args]]
+    if args.watch:
+        return watch(args, athletes)
+    if not args.manifest:
+        # With one athlete, their failure is the invocation's
+        try:
+            process_window(args, athletes[0][1])
+        finally:
+            report_profile(args)
+        return 0
+    counts = process_athletes(args, athletes)
+    failed = [athlete.name for (athlete, _), count in zip(athletes, counts) if count is None]
+    if len(failed) > 0:
+        logging.error("Unable to process %s" % (', '.join(failed)))
+        return 1
     return 0
 
 if __name__ == '__main__':